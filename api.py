@@ -1,12 +1,23 @@
 import re
 import os
+import queue
+import random
+import asyncio
+import threading
+import time
+from concurrent.futures import CancelledError, Future, as_completed
+import httpx
 import streamlit as st
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI
 import pandas as pd
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Awaitable, Union, Callable, Set
 # from data_analyzer import DataAnalyzer, create_data_context
 from data_analyzer import create_data_context
-from utils import execute_code
+from sandbox import run_code
+from code_result import CodeResult
+from prompt_builder import build_messages, truncate_tool_result
+from table_serializer import serialize_table
 import json
 
 def get_api_key():
@@ -15,6 +26,139 @@ def get_api_key():
         api_key = os.environ.get("OPENAI_API_KEY")
     return api_key
 
+# Pool di connessioni HTTP verso OpenAI (configurabile da variabili d'ambiente)
+OPENAI_POOL_SIZE = int(os.environ.get("OPENAI_POOL_SIZE", 20))
+OPENAI_KEEPALIVE_SECONDS = float(os.environ.get("OPENAI_KEEPALIVE_SECONDS", 60))
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_TIMEOUT_SECONDS", 120))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_CONNECT_TIMEOUT_SECONDS", 10))
+
+_clients: Dict[str, OpenAI] = {}
+_async_clients: Dict[str, AsyncOpenAI] = {}
+_clients_lock = threading.Lock()
+_http_transport: Optional[httpx.BaseTransport] = None
+
+# Event loop asyncio condiviso dal processo, eseguito in un thread dedicato: ospita le richieste delle varianti async
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+# Richieste in corso per proprietario (es. la sessione Streamlit), annullabili con cancel_requests
+_pending: Dict[str, Set[Future]] = {}
+_pending_lock = threading.Lock()
+
+def set_http_transport(transport: Optional[httpx.BaseTransport]) -> None:
+    """
+    Sostituisce il trasporto HTTP usato dai client (es. httpx.MockTransport nei test, None per quello reale)
+    e chiude i client già creati.
+    """
+    global _http_transport
+    with _clients_lock:
+        _http_transport = transport
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        for client in _async_clients.values():
+            asyncio.run_coroutine_threadsafe(client.close(), get_event_loop())
+        _async_clients.clear()
+
+def get_openai_client(api_key: Optional[str] = None) -> OpenAI:
+    """
+    Restituisce il client OpenAI condiviso dal processo per questa API key (thread-safe):
+    le connessioni HTTP keep-alive del pool vengono riusate da tutte le richieste e le sessioni.
+    """
+    api_key = api_key or get_api_key()
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            timeout = httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS)
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=OPENAI_POOL_SIZE,
+                                    max_keepalive_connections=OPENAI_POOL_SIZE,
+                                    keepalive_expiry=OPENAI_KEEPALIVE_SECONDS),
+                timeout=timeout,
+                transport=_http_transport
+            )
+            client = OpenAI(api_key=api_key, timeout=timeout, http_client=http_client)
+            _clients[api_key] = client
+    return client
+
+def get_async_openai_client(api_key: Optional[str] = None) -> AsyncOpenAI:
+    """Come get_openai_client, per le varianti async: il client va usato solo sull'event loop condiviso"""
+    api_key = api_key or get_api_key()
+    with _clients_lock:
+        client = _async_clients.get(api_key)
+        if client is None:
+            timeout = httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS)
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=OPENAI_POOL_SIZE,
+                                    max_keepalive_connections=OPENAI_POOL_SIZE,
+                                    keepalive_expiry=OPENAI_KEEPALIVE_SECONDS),
+                timeout=timeout,
+                transport=_http_transport
+            )
+            client = AsyncOpenAI(api_key=api_key, timeout=timeout, http_client=http_client)
+            _async_clients[api_key] = client
+    return client
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop condiviso dal processo (avviato al primo uso in un thread daemon)"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-event-loop", daemon=True).start()
+    return _loop
+
+def submit(coroutine: Awaitable[Any], owner: Optional[str] = None) -> Future:
+    """
+    Esegue la coroutine sull'event loop condiviso e restituisce un concurrent.futures.Future.
+    Con owner (es. l'ID della sessione) la richiesta può essere annullata con cancel_requests(owner).
+    """
+    future = asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+    if owner is not None:
+        with _pending_lock:
+            _pending.setdefault(owner, set()).add(future)
+        future.add_done_callback(lambda done: _forget_request(owner, done))
+    return future
+
+def _forget_request(owner: str, future: Future) -> None:
+    with _pending_lock:
+        futures = _pending.get(owner)
+        if futures is not None:
+            futures.discard(future)
+            if not futures:
+                del _pending[owner]
+
+def cancel_requests(owner: str) -> int:
+    """Annulla le richieste in corso di owner (le connessioni in streaming vengono chiuse); restituisce quante erano attive"""
+    with _pending_lock:
+        futures = _pending.pop(owner, set())
+    return sum(future.cancel() for future in futures)
+
+def stream_sync(response: Awaitable[AsyncIterator[str]], owner: Optional[str] = None) -> Iterator[str]:
+    """
+    Iteratore sincrono (per lo script Streamlit) di una risposta in streaming delle varianti async (stream=True).
+    I delta vengono letti sull'event loop mentre il chiamante renderizza quelli già arrivati; se il chiamante
+    smette di leggere la richiesta viene annullata, se viene annullata (cancel_requests) la risposta termina qui.
+    """
+    deltas: queue.Queue = queue.Queue()
+    end = object()
+
+    async def read():
+        try:
+            async for delta in await response:
+                deltas.put(delta)
+        finally:
+            deltas.put(end)
+
+    future = submit(read(), owner)
+    try:
+        while (delta := deltas.get()) is not end:
+            yield delta
+        future.result()
+    except CancelledError:
+        pass
+    finally:
+        future.cancel()
+
 system_prompt_generale = """
 Sei un esperto specializzato nell'analisi di dati, soprattutto dati statistici, ti chiami Storylaizer.
 Hai una profonda conoscenza di Python e delle librerie pandas e numpy.
@@ -80,55 +224,248 @@ Regole se l'utente ti chiede di generare report o commenti:
 
 """
 
-def ask_openai_analysis(history: List[Dict]
-                        , model: str
-                        , df: pd.DataFrame
-                        , temperature: float
-                        , top_p: float) -> str:
+execute_code_function = {"name":"execute_code", "description":"Esegue codice su df",
+                         "parameters":{"type":"object","properties":{"code":{"type":"string"}},"required":["code"]}}
+
+
+# In streaming l'ultimo chunk riporta l'utilizzo dei token (compresi quelli serviti dalla cache dei prompt)
+_STREAM_OPTIONS = {"include_usage": True}
+
+
+def _record_usage(metrics: Optional[Dict[str, Any]], usage: Any) -> None:
+    """Somma in metrics i token del prompt conteggiati dall'API ("api_prompt_tokens") e quelli letti dalla cache dei prompt ("cached_tokens")"""
+    if metrics is None or usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    metrics["api_prompt_tokens"] = metrics.get("api_prompt_tokens", 0) + (usage.prompt_tokens or 0)
+    metrics["cached_tokens"] = metrics.get("cached_tokens", 0) + ((getattr(details, "cached_tokens", 0) or 0) if details else 0)
+
+
+def _read_chunk(chunk
+                , metrics: Optional[Dict[str, Any]]
+                , start: float
+                , function_call: Optional[Dict[str, str]] = None) -> Optional[str]:
     """
-    Risponde alle domande sull'analisi dati usando function-calling Python solo se df è presente.
+    Elabora un chunk di una risposta in streaming e ne restituisce il testo (None se assente), registrando il tempo
+    al primo token e l'utilizzo dei token; se passato, function_call accumula i frammenti della function call.
+    """
+    _record_usage(metrics, getattr(chunk, "usage", None))
+    if not chunk.choices:
+        return None
+    delta = chunk.choices[0].delta
+    if function_call is not None and delta.function_call:
+        function_call["name"] += delta.function_call.name or ""
+        function_call["arguments"] += delta.function_call.arguments or ""
+        return None
+    if delta.content:
+        if metrics is not None and "ttft" not in metrics:
+            metrics["ttft"] = time.perf_counter() - start
+        return delta.content
+    return None
+
+
+def _stream_content(stream, metrics: Optional[Dict[str, Any]], start: float) -> Iterator[str]:
+    """Restituisce i delta di testo di una risposta in streaming, registrando il tempo al primo token e l'utilizzo dei token"""
+    for chunk in stream:
+        content = _read_chunk(chunk, metrics, start)
+        if content:
+            yield content
+
+
+async def _stream_content_async(stream, metrics: Optional[Dict[str, Any]], start: float) -> AsyncIterator[str]:
+    """Come _stream_content, per le risposte di AsyncOpenAI (la connessione viene chiusa anche se la lettura è annullata)"""
+    async with stream:
+        async for chunk in stream:
+            content = _read_chunk(chunk, metrics, start)
+            if content:
+                yield content
+
+
+def _run_function_call(function_call: Dict[str, str]
+                       , df: pd.DataFrame
+                       , model: str
+                       , results: Optional[List[CodeResult]] = None) -> List[Dict]:
+    """
+    Esegue il codice richiesto dal modello e prepara i messaggi per la risposta di follow-up:
+    il modello riceve la versione ridotta del risultato (CodeResult.to_prompt), results quello completo.
+    """
+    args = json.loads(function_call["arguments"])
+    result = run_code(args["code"], df)
+    if isinstance(result, CodeResult):
+        content = result.to_prompt()
+        if results is not None:
+            results.append(result)
+    else:
+        content = json.dumps(str(result))
+    return [
+        {"role":"assistant","function_call":function_call},
+        {"role":"function","name":"execute_code","content":truncate_tool_result(content, model)}
+    ]
+
+
+def _followup_request(request: Dict[str, Any]
+                      , function_call: Dict[str, str]
+                      , df: pd.DataFrame
+                      , results: Optional[List[CodeResult]] = None) -> Dict[str, Any]:
+    """
+    Richiesta di follow-up con il risultato del codice: riusa gli stessi messaggi (system, cronologia) e le stesse
+    funzioni della prima richiesta, che restano un prefisso identico servito dalla cache dei prompt del provider.
+    """
+    return dict(request
+                , messages=request["messages"] + _run_function_call(function_call, df, request["model"], results)
+                , function_call="none")
+
+
+def _analysis_request(history: List[Dict]
+                      , model: str
+                      , df: pd.DataFrame
+                      , temperature: float
+                      , top_p: float
+                      , metrics: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Richiesta di ask_openai_analysis: il prompt inizia sempre con le istruzioni statiche seguite dal contesto del
+    foglio (memorizzato per impronta), così che la parte iniziale resti identica tra i turni e tra le due richieste
+    del function-calling.
     """
     # Contesto dati
     data_context = f"\n\n DATASET REPORT CONTEXT:\n{create_data_context(df)}"
+    system_content = system_prompt_generale + system_prompt_analisi_df + data_context
 
     # Chiediamo al modello di produrre Python
-    client = OpenAI(api_key=get_api_key())
-    response = client.chat.completions.create(
+    return dict(
         model=model,
-        messages=[{"role":"system"
-                   ,"content":system_prompt_generale + system_prompt_analisi_df + data_context}]
-                + history,
-        functions=[{"name":"execute_code", "description":"Esegue codice su df",
-                    "parameters":{"type":"object","properties":{"code":{"type":"string"}},"required":["code"]}}],
+        messages=build_messages(system_content, history, model, metrics),
+        functions=[execute_code_function],
         function_call="auto",
         temperature=temperature,
         top_p=top_p
     )
+
+
+def ask_openai_analysis(history: List[Dict]
+                        , model: str
+                        , df: pd.DataFrame
+                        , temperature: float
+                        , top_p: float
+                        , stream: bool = False
+                        , metrics: Optional[Dict[str, Any]] = None
+                        , results: Optional[List[CodeResult]] = None) -> Union[str, Iterator[str]]:
+    """
+    Risponde alle domande sull'analisi dati usando function-calling Python solo se df è presente.
+    Se passata, results riceve i risultati completi del codice eseguito (es. per mostrarne le tabelle all'utente).
+    Con stream=True restituisce un iteratore dei delta di testo (anche per il follow-up del function-calling);
+    se passato, metrics viene popolato con il tempo al primo token ("ttft"), il tempo totale ("total_time"),
+    i token del prompt ("prompt_tokens", "prompt_tokens_full": vedi build_messages) e quelli riportati dall'API
+    ("api_prompt_tokens", "cached_tokens": vedi _record_usage).
+    """
+    start = time.perf_counter()
+    client = get_openai_client()
+    request = _analysis_request(history, model, df, temperature, top_p, metrics)
+    if stream:
+        return _stream_analysis(client, request, df, metrics, start, results)
+
+    response = client.chat.completions.create(**request)
+    _record_usage(metrics, response.usage)
     msg = response.choices[0].message
     if msg.function_call:
-        args = json.loads(msg.function_call.arguments)
-        result = execute_code(args["code"], df)
-        followup = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt_generale + system_prompt_analisi_df + data_context},
-                {"role":"assistant","function_call":msg.function_call},
-                {"role":"function","name":"execute_code","content":json.dumps(str(result))}
-            ]
-        )
-        return followup.choices[0].message.content
+        function_call = {"name": msg.function_call.name, "arguments": msg.function_call.arguments}
+        followup = client.chat.completions.create(**_followup_request(request, function_call, df, results))
+        _record_usage(metrics, followup.usage)
+        content = followup.choices[0].message.content
     else:
-        return msg.content
+        content = msg.content
+    if metrics is not None:
+        metrics["ttft"] = metrics["total_time"] = time.perf_counter() - start
+    return content
 
 
-def ask_openai_report(history: List[Dict]
-                      , model: str
-                      , df: pd.DataFrame
-                      , temperature: float
-                      , top_p: float) -> str:
+def _stream_analysis(client: OpenAI
+                     , request: Dict[str, Any]
+                     , df: pd.DataFrame
+                     , metrics: Optional[Dict[str, Any]]
+                     , start: float
+                     , results: Optional[List[CodeResult]] = None) -> Iterator[str]:
+    """Versione in streaming di ask_openai_analysis: gli argomenti della function call arrivano a frammenti"""
+    function_call = {"name": "", "arguments": ""}
+    for chunk in client.chat.completions.create(**request, stream=True, stream_options=_STREAM_OPTIONS):
+        content = _read_chunk(chunk, metrics, start, function_call)
+        if content:
+            yield content
+
+    if function_call["name"]:
+        followup = client.chat.completions.create(**_followup_request(request, function_call, df, results)
+                                                  , stream=True, stream_options=_STREAM_OPTIONS)
+        yield from _stream_content(followup, metrics, start)
+    if metrics is not None:
+        metrics["total_time"] = time.perf_counter() - start
+
+
+async def ask_openai_analysis_async(history: List[Dict]
+                                    , model: str
+                                    , df: pd.DataFrame
+                                    , temperature: float
+                                    , top_p: float
+                                    , stream: bool = False
+                                    , metrics: Optional[Dict[str, Any]] = None
+                                    , results: Optional[List[CodeResult]] = None) -> Union[str, AsyncIterator[str]]:
     """
-    Risponde alle domande di report includendo il contesto completo di df.
+    Variante async di ask_openai_analysis (stessi argomenti; con stream=True restituisce un iteratore async),
+    da eseguire sull'event loop condiviso con submit o stream_sync.
+    Il contesto dei dati e il codice generato vengono calcolati in un thread, così le altre richieste sul loop
+    (es. le risposte in streaming delle altre sessioni) proseguono nel frattempo.
     """
+    start = time.perf_counter()
+    client = get_async_openai_client()
+    request = await asyncio.to_thread(_analysis_request, history, model, df, temperature, top_p, metrics)
+    if stream:
+        return _stream_analysis_async(client, request, df, metrics, start, results)
+
+    response = await client.chat.completions.create(**request)
+    _record_usage(metrics, response.usage)
+    msg = response.choices[0].message
+    if msg.function_call:
+        function_call = {"name": msg.function_call.name, "arguments": msg.function_call.arguments}
+        followup_request = await asyncio.to_thread(_followup_request, request, function_call, df, results)
+        followup = await client.chat.completions.create(**followup_request)
+        _record_usage(metrics, followup.usage)
+        content = followup.choices[0].message.content
+    else:
+        content = msg.content
+    if metrics is not None:
+        metrics["ttft"] = metrics["total_time"] = time.perf_counter() - start
+    return content
+
+
+async def _stream_analysis_async(client: AsyncOpenAI
+                                 , request: Dict[str, Any]
+                                 , df: pd.DataFrame
+                                 , metrics: Optional[Dict[str, Any]]
+                                 , start: float
+                                 , results: Optional[List[CodeResult]] = None) -> AsyncIterator[str]:
+    """Versione in streaming di ask_openai_analysis_async"""
+    function_call = {"name": "", "arguments": ""}
+    async with await client.chat.completions.create(**request, stream=True, stream_options=_STREAM_OPTIONS) as response:
+        async for chunk in response:
+            content = _read_chunk(chunk, metrics, start, function_call)
+            if content:
+                yield content
+
+    if function_call["name"]:
+        followup_request = await asyncio.to_thread(_followup_request, request, function_call, df, results)
+        followup = await client.chat.completions.create(**followup_request, stream=True, stream_options=_STREAM_OPTIONS)
+        async for content in _stream_content_async(followup, metrics, start):
+            yield content
+    if metrics is not None:
+        metrics["total_time"] = time.perf_counter() - start
+
+
+def _report_request(history: List[Dict]
+                    , model: str
+                    , df: pd.DataFrame
+                    , temperature: float
+                    , top_p: float
+                    , metrics: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Richiesta di ask_openai_report, con la tabella df serializzata nel prompt di sistema"""
     # Genero un prompt che include create_data_context(df_report)
     if df is None or df.empty:
         system_prompt_dati = f"""Chiedi all'utente di fornire un dataset da analizzare."""
@@ -136,13 +473,200 @@ def ask_openai_report(history: List[Dict]
         system_prompt_dati = f"""
 
 Ecco i dati che hai a disposizione per generare il report:
-<TABELLA>{df.to_markdown(index=False)}</TABELLA>
+<TABELLA>
+{serialize_table(df, model)}
+</TABELLA>
 """
-    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-    response = client.chat.completions.create(
+    return dict(
         model=model,
-        messages=[{"role":"system","content":system_prompt_generale + system_prompt_report + system_prompt_dati}] + history,
+        messages=build_messages(system_prompt_generale + system_prompt_report + system_prompt_dati, history, model, metrics),
         temperature=temperature,
         top_p=top_p
     )
-    return response.choices[0].message.content
\ No newline at end of file
+
+
+def ask_openai_report(history: List[Dict]
+                      , model: str
+                      , df: pd.DataFrame
+                      , temperature: float
+                      , top_p: float
+                      , stream: bool = False
+                      , metrics: Optional[Dict[str, Any]] = None) -> Union[str, Iterator[str]]:
+    """
+    Risponde alle domande di report includendo il contesto completo di df.
+    Con stream=True restituisce un iteratore dei delta di testo (metrics come in ask_openai_analysis).
+    """
+    start = time.perf_counter()
+    client = get_openai_client()
+    request = _report_request(history, model, df, temperature, top_p, metrics)
+    if stream:
+        return _stream_report(client, request, metrics, start)
+
+    response = client.chat.completions.create(**request)
+    _record_usage(metrics, response.usage)
+    if metrics is not None:
+        metrics["ttft"] = metrics["total_time"] = time.perf_counter() - start
+    return response.choices[0].message.content
+
+
+def _stream_report(client: OpenAI
+                   , request: Dict[str, Any]
+                   , metrics: Optional[Dict[str, Any]]
+                   , start: float) -> Iterator[str]:
+    """Versione in streaming di ask_openai_report"""
+    yield from _stream_content(client.chat.completions.create(**request, stream=True, stream_options=_STREAM_OPTIONS), metrics, start)
+    if metrics is not None:
+        metrics["total_time"] = time.perf_counter() - start
+
+
+async def ask_openai_report_async(history: List[Dict]
+                                  , model: str
+                                  , df: pd.DataFrame
+                                  , temperature: float
+                                  , top_p: float
+                                  , stream: bool = False
+                                  , metrics: Optional[Dict[str, Any]] = None) -> Union[str, AsyncIterator[str]]:
+    """Variante async di ask_openai_report (vedi ask_openai_analysis_async); la tabella viene serializzata in un thread"""
+    start = time.perf_counter()
+    client = get_async_openai_client()
+    request = await asyncio.to_thread(_report_request, history, model, df, temperature, top_p, metrics)
+    if stream:
+        return _stream_report_async(client, request, metrics, start)
+
+    response = await client.chat.completions.create(**request)
+    _record_usage(metrics, response.usage)
+    if metrics is not None:
+        metrics["ttft"] = metrics["total_time"] = time.perf_counter() - start
+    return response.choices[0].message.content
+
+
+async def _stream_report_async(client: AsyncOpenAI
+                               , request: Dict[str, Any]
+                               , metrics: Optional[Dict[str, Any]]
+                               , start: float) -> AsyncIterator[str]:
+    """Versione in streaming di ask_openai_report_async"""
+    response = await client.chat.completions.create(**request, stream=True, stream_options=_STREAM_OPTIONS)
+    async for content in _stream_content_async(response, metrics, start):
+        yield content
+    if metrics is not None:
+        metrics["total_time"] = time.perf_counter() - start
+
+
+# Generazione parallela di report per riga (Report Builder)
+REPORT_BATCH_ROWS = 10      # Righe inviate in ogni richiesta
+REPORT_BATCH_WORKERS = 8    # Richieste concorrenti
+REPORT_MAX_RETRIES = 5      # Tentativi per richiesta in caso di rate limit o errori temporanei
+REPORT_MISSING_TEXT = "⚠️ Report non generato per questa riga."
+
+system_prompt_report_righe = """
+Devi generare un report per CIASCUNA riga della tabella fornita, seguendo le istruzioni dell'utente.
+La colonna "riga" identifica la riga: non commentarla e non citarla nel testo del report.
+Rispondi SOLO con un oggetto JSON nel formato {"reports": [{"riga": <numero riga>, "report": "<testo del report>"}]},
+con un elemento per ogni riga della tabella.
+"""
+
+# Errori temporanei per cui ha senso ritentare la richiesta
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+async def _call_with_backoff(request: Callable[[], Awaitable[Any]], max_retries: int = REPORT_MAX_RETRIES) -> Any:
+    """
+    Esegue la richiesta ritentando gli errori temporanei con backoff esponenziale e jitter;
+    se il server indica un header retry-after (rate limit) viene rispettato.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await request()
+        except _RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = 2 ** attempt + random.uniform(0, 1)
+            response = getattr(e, "response", None)
+            retry_after = response.headers.get("retry-after") if response is not None else None
+            if retry_after:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            await asyncio.sleep(delay)
+
+
+async def _generate_report_batch(rows: pd.DataFrame
+                                 , instructions: str
+                                 , model: str
+                                 , temperature: float
+                                 , top_p: float
+                                 , limit: asyncio.Semaphore) -> Dict[int, str]:
+    """
+    Genera i report di un gruppo di righe con una sola richiesta; restituisce {posizione riga: report}.
+    limit è condiviso dai gruppi e ne limita le richieste contemporanee (attese di backoff comprese).
+    """
+    table = rows.reset_index(drop=True)
+    table.insert(0, "riga", rows.index)
+    # Nessun retry interno del client: i tentativi (e il loro backoff) sono gestiti solo da _call_with_backoff
+    client = get_async_openai_client().with_options(max_retries=0)
+    async with limit:
+        response = await _call_with_backoff(lambda: client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role":"system","content":system_prompt_generale + system_prompt_report + system_prompt_report_righe},
+                {"role":"user","content":f"{instructions}\n\n<TABELLA>\n{serialize_table(table, model, use_cache=False)}\n</TABELLA>"}
+            ],
+            response_format={"type": "json_object"},
+            temperature=temperature,
+            top_p=top_p
+        ))
+    reports = {}
+    for item in json.loads(response.choices[0].message.content).get("reports", []):
+        try:
+            reports[int(item["riga"])] = str(item["report"])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return reports
+
+
+def generate_row_reports(df: pd.DataFrame
+                         , instructions: str
+                         , label_column: str
+                         , model: str
+                         , temperature: float
+                         , top_p: float
+                         , rows_per_request: int = REPORT_BATCH_ROWS
+                         , max_workers: int = REPORT_BATCH_WORKERS
+                         , progress_callback: Optional[Callable[[int, int], None]] = None
+                         , owner: Optional[str] = None) -> pd.DataFrame:
+    """
+    Genera un report per ogni riga di df suddividendo la tabella in gruppi di rows_per_request righe,
+    inviati in parallelo sull'event loop condiviso (al massimo max_workers richieste contemporanee, con backoff
+    sui rate limit). Restituisce una tabella a due colonne (label_column, "Report") nell'ordine originale delle righe.
+    progress_callback(righe completate, righe totali) viene chiamata dal thread chiamante; se questo viene interrotto,
+    o se owner viene annullato con cancel_requests, i gruppi non ancora completati non vengono più richiesti.
+    """
+    rows = df.reset_index(drop=True)
+    groups = [rows.iloc[start:start + rows_per_request] for start in range(0, len(rows), rows_per_request)]
+    reports = {}
+    completed = 0
+
+    limit = asyncio.Semaphore(max_workers)
+    futures = {submit(_generate_report_batch(group, instructions, model, temperature, top_p, limit), owner): group
+               for group in groups}
+    try:
+        for future in as_completed(futures):
+            group = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                reports.update(future.result())
+            except Exception as e:
+                reports.update({position: f"⚠️ Errore nella generazione del report: {e}" for position in group.index})
+            completed += len(group)
+            if progress_callback:
+                progress_callback(completed, len(rows))
+    finally:
+        for future in futures:
+            future.cancel()
+
+    return pd.DataFrame({
+        label_column: rows[label_column],
+        "Report": [reports.get(position, REPORT_MISSING_TEXT) for position in rows.index]
+    })
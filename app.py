@@ -6,13 +6,19 @@ from dotenv import load_dotenv
 import io
 import json
 from openai import OpenAI
-from ui_components import handle_chat_input, render_user_message, render_response, load_css, render_header, display_chat_history, render_conversation_options, render_data_preview, render_download_conversation
+from ui_components import handle_chat_input, render_user_message, render_response, load_css, render_header, display_chat_history, render_conversation_options, render_data_preview, render_download_conversation, render_row_reports, render_load_stats
 from utils import reset_conversation, init_session_state, export_chat, execute_code
+from sandbox import invalidate_results
+from data_loader import get_sheet_names, load_sheet, get_load_stats, SUPPORTED_FILE_TYPES
 
-max_righe_per_report = 250 # Numero massimo di righe per generare un report
+max_righe_per_report = 250 # Numero massimo di righe per generare un report in chat (per tabelle più grandi: report per riga)
 if not os.environ.get("STREAMLIT_SHARING"):
     load_dotenv()
 
+# I DataFrame caricati sono condivisi in sola lettura tra le sessioni (stesso file = stesso oggetto):
+# con Copy-on-Write le modifiche su viste e DataFrame derivati non alterano mai l'originale
+pd.set_option("mode.copy_on_write", True)
+
 def main():
     st.set_page_config(page_title="Storylaizer", page_icon="img/storylaizer_favicon.png", layout="centered")
     load_css()
@@ -46,19 +52,26 @@ def main():
         
         uploader_key1 = f"uploader1_{st.session_state.session_id}"
         with st.expander("📂 Carica il file da analizzare", expanded=True):
-            uploaded_file1 = st.file_uploader(label="Seleziona un file Excel con i dati da analizzare", type=["xlsx"], key=uploader_key1)
+            uploaded_file1 = st.file_uploader(label="Seleziona un file Excel (o CSV/Parquet) con i dati da analizzare", type=SUPPORTED_FILE_TYPES, key=uploader_key1)
             if uploaded_file1:
                 # Scelta dello Sheet
-                xls = pd.ExcelFile(uploaded_file1)
-                sheet_names = xls.sheet_names
+                sheet_names = get_sheet_names(uploaded_file1)
                 selected_sheet = st.selectbox("📑 Seleziona il foglio", options=sheet_names, index=0, key=f"sheet_sel1_{st.session_state.session_id}")
-                df = pd.read_excel(uploaded_file1, sheet_name=selected_sheet)
+                df = load_sheet(uploaded_file1, selected_sheet)
+                # Nuovo file o foglio: i risultati memorizzati per i dati precedenti non servono più
+                data_source = (uploaded_file1.name, uploaded_file1.size, selected_sheet)
+                if st.session_state.get("data_source1") != data_source:
+                    if "dataframe" in st.session_state:
+                        invalidate_results(st.session_state.dataframe)
+                    st.session_state.data_source1 = data_source
                 st.session_state.dataframe = df
                 st.session_state.file_loaded1 = True
                 st.success(f"✅ Hai caricato: {uploaded_file1.name} (sheet: {selected_sheet})")
+                load_stats = get_load_stats(uploaded_file1, selected_sheet)
+                render_load_stats(load_stats)
                 
                 # Anteprima dei dati caricati
-                render_data_preview(df)
+                render_data_preview(df, load_stats, key=f"preview1_{st.session_state.session_id}")
                         
         # Area di chat dopo il caricamento del file
         if st.session_state.file_loaded1:
@@ -83,7 +96,8 @@ def main():
                         <li>Se invece hai già un report “esempio” che ti piace (magari per una certa regione), incollalo nel prompt come modello. Ad esempio: 
                             <i>"Ecco il report per la Regione X: [INCOLLA QUI TESTO REPORT]. Genera lo stesso tipo di report per le altre regioni."</i></li>
                     </ol>
-                    <strong>Ricorda:</strong> puoi generare report a partire da una <strong>tabella</strong> con un massimo di <strong>{max_righe_per_report} righe</strong>.<br><br>
+                    <strong>Ricorda:</strong> in chat puoi generare report a partire da una <strong>tabella</strong> con un massimo di <strong>{max_righe_per_report} righe</strong>; 
+                    per tabelle più grandi usa <strong>"🧩 Genera un report per ogni riga"</strong>, che elabora le righe in parallelo senza limiti di dimensione.<br><br>
                     Poi anche decidere di generare un report utilizzando il tab <strong>"🤖 AI Chat"</strong> in alto, in questo caso però dovrai incollare la tabella direttamente nella chat. <br>
                     Se invece sei interessato ad effettuare un'<strong>analisi statistica</strong> o effettuare dei <strong>calcoli</strong>, passa alla <i>tab</i> <strong>"🔍 Data Analyzer"</strong> in alto.
                     </div><br>"""
@@ -93,23 +107,27 @@ def main():
         
         uploader_key2 = f"uploader2_{st.session_state.session_id}"
         with st.expander("📂 Carica il file per il report", expanded=True):
-            uploaded_file2 = st.file_uploader(label="Seleziona un file Excel per generare un report", type=["xlsx"], key=uploader_key2)
+            uploaded_file2 = st.file_uploader(label="Seleziona un file Excel (o CSV/Parquet) per generare un report", type=SUPPORTED_FILE_TYPES, key=uploader_key2)
             if uploaded_file2:
                 # Scelta dello Sheet
-                xls = pd.ExcelFile(uploaded_file2)
-                sheet_names = xls.sheet_names
+                sheet_names = get_sheet_names(uploaded_file2)
                 selected_sheet = st.selectbox("📑 Seleziona il foglio", options=sheet_names, index=0, key=f"sheet_sel2_{st.session_state.session_id}")
-                df = pd.read_excel(uploaded_file2, sheet_name=selected_sheet)
+                df = load_sheet(uploaded_file2, selected_sheet)
                 st.session_state.dataframe_report = df
                 st.session_state.file_loaded2 = True
                 st.success(f"✅ Hai caricato: {uploaded_file2.name} (sheet: {selected_sheet})")
+                load_stats = get_load_stats(uploaded_file2, selected_sheet)
+                render_load_stats(load_stats)
                 
                 # Anteprima dei dati caricati
-                render_data_preview(df)
+                render_data_preview(df, load_stats, key=f"preview2_{st.session_state.session_id}")
                 n_righe_file = df.shape[0]
 
                 if n_righe_file > max_righe_per_report:
-                    st.markdown(f"<div class='mode-title' style='color: red;'>ATTENZIONE: Il file è troppo grande per la generazione di report</div><div class='mode-subtitle' style='color: red;'>Il file contiene {n_righe_file} righe, il sistema può generare report a partire da un massimo di 250. Carica un file più piccolo.</div><br>", unsafe_allow_html=True)
+                    st.markdown(f"<div class='mode-title' style='color: red;'>ATTENZIONE: Il file è troppo grande per la generazione di report in chat</div><div class='mode-subtitle' style='color: red;'>Il file contiene {n_righe_file} righe, la chat può generare report a partire da un massimo di {max_righe_per_report}. Usa la generazione di un report per ogni riga qui sotto.</div><br>", unsafe_allow_html=True)
+
+                # Report per riga con richieste parallele (nessun limite di righe)
+                render_row_reports(df)
 
                         
         # Area di chat dopo il caricamento del file
@@ -0,0 +1,125 @@
+import hashlib
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import pandas as pd
+
+
+class LRUCache:
+    """
+    Cache LRU thread-safe condivisa a livello di processo (tra turni e sessioni Streamlit).
+    Con max_bytes limita anche l'occupazione totale stimata dei valori (misurata con sizeof).
+    """
+
+    def __init__(self
+                 , max_entries: int = 32
+                 , max_bytes: Optional[int] = None
+                 , sizeof: Callable[[Any], int] = sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Restituisce il valore associato a key (aggiornandone la recenza) o default"""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Inserisce un valore, eliminando gli elementi meno usati oltre i limiti.
+        Un valore più grande di max_bytes resta comunque in cache, da solo: un foglio enorme
+        non verrebbe altrimenti mai memorizzato e sarebbe riletto a ogni rerun.
+        """
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._remove(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+            while len(self._data) > 1 and (len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key: Hashable) -> None:
+        if key in self._data:
+            del self._data[key]
+            self.total_bytes -= self._sizes.pop(key)
+
+    def discard_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Elimina gli elementi la cui chiave soddisfa predicate; restituisce quanti ne ha eliminati"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Restituisce il valore in cache oppure lo calcola (fuori dal lock) e lo memorizza"""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+# Impronte già calcolate per oggetto DataFrame (id -> (riferimento debole, impronta))
+_fingerprints = {}
+
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Calcola un'impronta economica del contenuto di un DataFrame:
+    schema (shape, nomi colonne, dtypes) + hash vettorizzato dei valori di ogni riga.
+    Due DataFrame con lo stesso contenuto producono la stessa impronta anche se sono oggetti diversi.
+    L'impronta viene memorizzata per oggetto finché questo esiste: i DataFrame dell'app (condivisi in sola
+    lettura tra le sessioni) non vengono modificati sul posto, quindi i rerun non ricalcolano l'hash.
+    """
+    memo = _fingerprints.get(id(df))
+    if memo is not None and memo[0]() is df:
+        return memo[1]
+    fingerprint = _compute_fingerprint(df)
+    key = id(df)
+    _fingerprints[key] = (weakref.ref(df, lambda _: _fingerprints.pop(key, None)), fingerprint)
+    return fingerprint
+
+
+def _compute_fingerprint(df: pd.DataFrame) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    schema = (df.shape, [str(col) for col in df.columns], [str(dtype) for dtype in df.dtypes])
+    digest.update(repr(schema).encode())
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        # Colonne con valori non hashabili (liste, dict, ...): ripiego sulla rappresentazione testuale
+        row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False)
+    digest.update(row_hashes.to_numpy().tobytes())
+    return digest.hexdigest()
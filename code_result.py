@@ -0,0 +1,103 @@
+import os
+from typing import Any, List, Optional
+
+import pandas as pd
+
+from table_serializer import format_column, format_float
+
+# Righe di un risultato tabellare inviate al modello (il resto viene riassunto; l'utente vede la tabella completa)
+RESULT_PROMPT_ROWS = int(os.environ.get("RESULT_PROMPT_ROWS", 50))
+
+
+def _plain_table(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    DataFrame semplice (non CIDataFrame) con colonne testuali: gli indici con nome o non numerici (es. i gruppi
+    di un groupby, le statistiche di describe) diventano colonne, le posizioni di riga vengono scartate.
+    """
+    frame = pd.DataFrame(frame)
+    if isinstance(frame.columns, pd.MultiIndex):
+        frame.columns = [" ".join(str(part) for part in column if str(part)) for column in frame.columns]
+    keep_index = (any(name is not None for name in frame.index.names)
+                  or not pd.api.types.is_integer_dtype(frame.index.dtype))
+    try:
+        frame = frame.reset_index(drop=not keep_index)
+    except ValueError:
+        # Il nome dell'indice coincide con una colonna già presente
+        frame = frame.reset_index(drop=True)
+    return frame
+
+
+class CodeResult:
+    """
+    Risultato tipizzato di execute_code. I DataFrame, le Series e le liste di dizionari sono conservati in table
+    (un DataFrame, con l'ordine originale delle colonne); gli altri valori (scalari, liste, dict, ...) in value.
+    Il modello riceve to_prompt(): al più RESULT_PROMPT_ROWS righe più un riepilogo del resto,
+    mentre l'interfaccia e l'esportazione usano direttamente la tabella completa.
+    """
+
+    def __init__(self, table: Optional[pd.DataFrame] = None, value: Any = None):
+        self.table = table
+        self.value = value
+
+    @classmethod
+    def from_value(cls, raw: Any) -> 'CodeResult':
+        if isinstance(raw, pd.DataFrame):
+            return cls(table=_plain_table(raw))
+        if isinstance(raw, pd.Series):
+            return cls(table=_plain_table(raw.to_frame(name=raw.name if raw.name is not None else "valore")))
+        if isinstance(raw, list) and raw and all(isinstance(row, dict) for row in raw):
+            # Le colonne seguono l'ordine di prima comparsa delle chiavi
+            return cls(table=pd.DataFrame(raw))
+        return cls(value=raw)
+
+    @property
+    def is_table(self) -> bool:
+        return self.table is not None
+
+    @property
+    def rows(self) -> int:
+        return len(self.table) if self.is_table else 0
+
+    @property
+    def truncated(self) -> bool:
+        """True se il modello riceve solo una parte delle righe"""
+        return self.rows > RESULT_PROMPT_ROWS
+
+    def to_markdown(self, max_rows: Optional[int] = None) -> str:
+        """Tabella markdown delle prime max_rows righe (tutte se None)"""
+        table = self.table if max_rows is None else self.table.head(max_rows)
+        names = [str(column).replace("|", "\\|") for column in table.columns]
+        columns = [[value.replace("|", "\\|") for value in format_column(table.iloc[:, position])]
+                   for position in range(table.shape[1])]
+        lines = ["| " + " | ".join(names) + " |", "| " + " | ".join(["---"] * len(names)) + " |"]
+        lines.extend("| " + " | ".join(row) + " |" for row in zip(*columns))
+        return "\n".join(lines)
+
+    def _numeric_summary(self) -> List[str]:
+        summary = []
+        for name in self.table.select_dtypes(include="number", exclude="bool").columns:
+            values = self.table[name].dropna()
+            if len(values):
+                summary.append(f"- {name}: min {format_float(float(values.min()))}, max {format_float(float(values.max()))}, "
+                               f"somma {format_float(float(values.sum()))}, media {format_float(float(values.mean()))}")
+        return summary
+
+    def to_prompt(self, max_rows: int = RESULT_PROMPT_ROWS) -> str:
+        """Testo per il modello: la tabella (troncata a max_rows righe con un riepilogo dell'intero risultato) o il valore"""
+        if not self.is_table:
+            return str(self.value)
+        if self.table.empty:
+            return f"Tabella vuota (colonne: {', '.join(map(str, self.table.columns))})"
+        text = self.to_markdown(max_rows)
+        if self.rows > max_rows:
+            lines = [text, "",
+                     f"Sono mostrate le prime {max_rows} righe su {self.rows} ({self.table.shape[1]} colonne): "
+                     "la tabella completa viene mostrata all'utente sotto la risposta, non riportarla per intero."]
+            summary = self._numeric_summary()
+            if summary:
+                lines += ["Statistiche calcolate su tutte le righe:"] + summary
+            text = "\n".join(lines)
+        return text
+
+    def __str__(self) -> str:
+        return self.to_prompt()
@@ -1,15 +1,281 @@
 import pandas as pd
 import numpy as np
 import json
-from typing import Dict, Any, List, Tuple
+import warnings
+from typing import Dict, Any, List, Tuple, Union
 import re
+from cache import LRUCache, dataframe_fingerprint
+
+# Cache di processo indicizzate per impronta del DataFrame: summary e contesto vengono calcolati
+# una sola volta per foglio e riutilizzati da tutti i turni di chat e da tutte le sessioni
+_summary_cache = LRUCache(max_entries=16)
+_context_cache = LRUCache(max_entries=16)
+
+# Numero massimo di celle per blocco nella profilazione vettorializzata delle colonne numeriche
+_NUMERIC_BLOCK_CELLS = 2**22
+
+# Tipi delle colonne di testo: object e, per i fogli compattati al caricamento, stringhe Arrow e categorie
+_TEXT_DTYPES = ['object', 'string', 'category']
+
+
+def _is_text_dtype(dtype) -> bool:
+    return (pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)
+            or isinstance(dtype, pd.CategoricalDtype))
+
+
+def _zero_out_fperr(values: np.ndarray) -> np.ndarray:
+    """Azzera i residui numerici (stesso criterio usato da pandas per skew/kurtosis)"""
+    return np.where(np.abs(values) < 1e-14, 0, values)
+
+
+def _sorted_quantiles(sorted_block: np.ndarray, count: np.ndarray, probs: List[float]) -> List[np.ndarray]:
+    """
+    Quantili (interpolazione lineare, come numpy/pandas) di ogni colonna di un blocco già ordinato
+    con i NaN in coda: un solo ordinamento serve tutti i quantili richiesti.
+    """
+    last = np.maximum(count - 1, 0).astype(np.intp)
+    columns = np.arange(sorted_block.shape[1])
+    quantiles = []
+    for prob in probs:
+        virtual = (count - 1) * prob
+        lower = np.clip(np.floor(virtual), 0, None).astype(np.intp)
+        upper = np.minimum(lower + 1, last)
+        gamma = virtual - lower
+        a = sorted_block[lower, columns]
+        b = sorted_block[upper, columns]
+        diff = b - a
+        # Stessa formula di interpolazione di numpy (_lerp) per risultati identici
+        values = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+        values[count == 0] = np.nan
+        quantiles.append(values)
+    return quantiles
+
+
+def _numeric_block_statistics(block: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Calcola le statistiche di tutte le colonne di un blocco 2-D float (NaN = mancante) in una passata:
+    un solo ordinamento per quantili, min, max e valori distinti e i momenti da somme condivise.
+    I risultati coincidono con quelli di pandas (std con ddof=1, skew e kurtosis corrette).
+    """
+    if block.shape[0] == 0:
+        # DataFrame senza righe: una riga di soli NaN produce statistiche tutte NaN
+        block = np.full((1, block.shape[1]), np.nan)
+    valid = ~np.isnan(block)
+    count = valid.sum(axis=0).astype(np.float64)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, block, 0).sum(axis=0) / count
+        centered = np.where(valid, block - mean, 0)
+        squared = centered ** 2
+        m2 = squared.sum(axis=0)
+        m3 = _zero_out_fperr((squared * centered).sum(axis=0))
+        m4 = (squared ** 2).sum(axis=0)
+        
+        skewness = (count * (count - 1) ** 0.5 / (count - 2)) * (m3 / _zero_out_fperr(m2) ** 1.5)
+        skewness = np.where(_zero_out_fperr(m2) == 0, 0, skewness)
+        skewness[count < 3] = np.nan
+        
+        adj = 3 * (count - 1) ** 2 / ((count - 2) * (count - 3))
+        numerator = _zero_out_fperr(count * (count + 1) * (count - 1) * m4)
+        denominator = _zero_out_fperr((count - 2) * (count - 3) * m2 ** 2)
+        kurtosis = numerator / denominator - adj
+        kurtosis = np.where(denominator == 0, 0, kurtosis)
+        kurtosis[count < 4] = np.nan
+        
+        # np.sort mette i NaN in coda: le prime `count` righe di ogni colonna sono i valori validi ordinati
+        sorted_block = np.sort(block, axis=0)
+        q25, median, q75 = _sorted_quantiles(sorted_block, count, [0.25, 0.5, 0.75])
+        minimum, maximum = _sorted_quantiles(sorted_block, count, [0.0, 1.0])
+        iqr = q75 - q25
+        outliers = ((block < q25 - 1.5 * iqr) | (block > q75 + 1.5 * iqr)).sum(axis=0)
+        
+        # Valori distinti = 1 + numero di "salti" tra valori validi consecutivi
+        changes = sorted_block[1:] != sorted_block[:-1]
+        in_range = np.arange(1, sorted_block.shape[0])[:, None] < count
+        unique = np.where(count > 0, 1 + (changes & in_range).sum(axis=0), 0)
+        
+        return {
+            'count': count,
+            'unique': unique,
+            'mean': np.round(mean, 4),
+            'median': np.round(median, 4),
+            'std': np.round(np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan), 4),
+            'min': minimum,
+            'max': maximum,
+            'q25': np.round(q25, 4),
+            'q75': np.round(q75, 4),
+            'skewness': np.round(skewness, 4),
+            'kurtosis': np.round(kurtosis, 4),
+            'outliers_count': outliers
+        }
+
+
+# Modalità di profilazione approssimata: sopra questa soglia di righe "auto" passa alla stima su campione
+APPROX_ROW_THRESHOLD = 1_000_000
+# Righe del campione casuale usato per quantili, skewness, outlier e caratteristiche del testo
+APPROX_SAMPLE_ROWS = 100_000
+# Precisione HyperLogLog (2^p registri, errore relativo ~1.04/sqrt(2^p) ≈ 0.8%)
+_HLL_PRECISION = 14
+
+
+def _hash_values(series: pd.Series) -> np.ndarray:
+    """Hash a 64 bit di ogni valore di una colonna, senza indice"""
+    try:
+        return pd.util.hash_pandas_object(series, index=False, categorize=False).to_numpy()
+    except TypeError:
+        # Valori non hashabili (liste, dict, ...): ripiego sulla rappresentazione testuale
+        return pd.util.hash_pandas_object(series.astype(str), index=False, categorize=False).to_numpy()
+
+
+def _approx_distinct_count(hashes: np.ndarray, precision: int = _HLL_PRECISION) -> int:
+    """Stima HyperLogLog del numero di valori distinti a partire dai loro hash a 64 bit"""
+    if len(hashes) == 0:
+        return 0
+    
+    registers_count = 1 << precision
+    remaining_bits = 64 - precision
+    # I primi p bit scelgono il registro, il rango è la posizione del primo bit a 1 nei restanti
+    buckets = (hashes >> np.uint64(remaining_bits)).astype(np.intp)
+    remainder = (hashes & np.uint64((1 << remaining_bits) - 1)).astype(np.float64)  # < 2^50: conversione esatta
+    with np.errstate(divide='ignore'):
+        ranks = np.where(remainder > 0, remaining_bits - np.floor(np.log2(remainder)), remaining_bits + 1)
+    registers = np.zeros(registers_count, dtype=np.uint8)
+    np.maximum.at(registers, buckets, ranks.astype(np.uint8))
+    
+    alpha = 0.7213 / (1 + 1.079 / registers_count)
+    estimate = alpha * registers_count ** 2 / np.sum(np.exp2(-registers.astype(np.float64)))
+    empty_registers = int((registers == 0).sum())
+    if estimate <= 2.5 * registers_count and empty_registers:
+        # Correzione per piccole cardinalità (linear counting)
+        estimate = registers_count * np.log(registers_count / empty_registers)
+    return int(round(min(estimate, len(hashes))))
+
+
+# Righe esaminate per blocco nella verifica delle gerarchie (uscita anticipata alla prima violazione)
+_HIERARCHY_CHUNK_ROWS = 65536
+
+
+def _is_functional_dependency(child_codes: np.ndarray, parent_codes: np.ndarray, child_cardinality: int) -> bool:
+    """
+    Verifica vettorialmente che ogni valore del figlio corrisponda a un solo valore (non mancante) del padre.
+    Le righe sono esaminate a blocchi: il primo blocco con una coppia incoerente interrompe la verifica.
+    """
+    parent_of = np.full(child_cardinality, -1, dtype=np.intp)
+    for start in range(0, len(child_codes), _HIERARCHY_CHUNK_ROWS):
+        child = child_codes[start:start + _HIERARCHY_CHUNK_ROWS]
+        parent = parent_codes[start:start + _HIERARCHY_CHUNK_ROWS]
+        both_present = (child >= 0) & (parent >= 0)
+        child, parent = child[both_present], parent[both_present]
+        
+        # Assegno il padre ai figli non ancora visti, poi verifico tutte le coppie del blocco
+        unseen = parent_of[child] == -1
+        parent_of[child[unseen]] = parent[unseen]
+        if (parent_of[child] != parent).any():
+            return False
+    
+    # Ogni valore del figlio deve comparire almeno una volta con un padre non mancante
+    return bool((parent_of >= 0).all())
+
+
+class CorrelationMatrix:
+    """
+    Matrice di correlazione di Pearson tra colonne numeriche, con osservazioni complete a coppie come
+    DataFrame.corr(). È mantenuta tramite statistiche sufficienti additive (conteggi, somme, somme dei
+    quadrati e prodotti incrociati) calcolate con prodotti matriciali su blocchi di righe: aggiungere
+    righe aggiorna le statistiche senza ripassare sui dati già visti.
+    """
+    
+    def __init__(self, columns: List[str], dtype: type = np.float64, block_rows: int = 65536):
+        """dtype: precisione dei blocchi (np.float32 dimezza memoria e tempo dei prodotti, np.float64 è più preciso)"""
+        self.columns = list(columns)
+        self.dtype = dtype
+        self.block_rows = block_rows
+        size = len(self.columns)
+        self._count = np.zeros((size, size))
+        self._sum = np.zeros((size, size))
+        self._sum_squares = np.zeros((size, size))
+        self._cross = np.zeros((size, size))
+        self._shift = None
+        self._matrix = None
+    
+    def update(self, rows: pd.DataFrame) -> 'CorrelationMatrix':
+        """Aggiunge le righe alle statistiche sufficienti e invalida la matrice calcolata"""
+        selected = rows[self.columns]
+        for start in range(0, len(rows), self.block_rows):
+            block = selected.iloc[start:start + self.block_rows].to_numpy(dtype=self.dtype, na_value=np.nan)
+            if self._shift is None:
+                # Centro i dati sulle medie del primo blocco: la correlazione non cambia e si evita la
+                # cancellazione numerica tra somme grandi nella formula dei momenti grezzi
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    self._shift = np.nan_to_num(np.nanmean(block, axis=0)).astype(self.dtype)
+            
+            block = block - self._shift
+            valid = ~np.isnan(block)
+            values = np.where(valid, block, 0)
+            mask = valid.astype(self.dtype)
+            # Elemento [i, j]: statistiche della colonna i sulle righe dove sono presenti sia i che j
+            self._count += mask.T @ mask
+            self._sum += values.T @ mask
+            self._sum_squares += (values * values).T @ mask
+            self._cross += values.T @ values
+        
+        self._matrix = None
+        return self
+    
+    @property
+    def matrix(self) -> pd.DataFrame:
+        """Matrice di correlazione (calcolata dalle statistiche alla prima richiesta dopo ogni aggiornamento)"""
+        if self._matrix is None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                covariance = self._cross - self._sum * self._sum.T / self._count
+                variance = self._sum_squares - self._sum ** 2 / self._count
+                correlation = np.clip(covariance / np.sqrt(variance * variance.T), -1, 1)
+            correlation[(variance <= 0) | (variance.T <= 0) | (self._count < 1)] = np.nan
+            self._matrix = pd.DataFrame(correlation, index=self.columns, columns=self.columns)
+        return self._matrix
+    
+    def high_correlations(self, threshold: float = 0.7) -> List[Dict[str, Any]]:
+        """Coppie di colonne (triangolo superiore, in ordine di colonna) con |r| > threshold"""
+        rows, cols = np.triu_indices(len(self.columns), k=1)
+        values = self.matrix.to_numpy()[rows, cols]
+        selected = np.flatnonzero(np.abs(values) > threshold)
+        return [{
+            'col1': self.columns[rows[k]],
+            'col2': self.columns[cols[k]],
+            'correlation': round(values[k], 3)
+        } for k in selected]
+
 
 class DataAnalyzer:
     """Classe per analizzare DataFrame e fornire informazioni strutturate all'AI"""
     
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, df: pd.DataFrame, mode: str = 'auto'):
+        """
+        mode: 'exact' calcola tutto sull'intero DataFrame, 'approximate' stima le statistiche costose
+        (quantili, distinti, duplicati, memoria) su campione/hash, 'auto' passa ad 'approximate'
+        sopra APPROX_ROW_THRESHOLD righe.
+        """
+        if mode not in ('auto', 'exact', 'approximate'):
+            raise ValueError(f"Mode '{mode}' not supported")
         self.df = df
         self.analysis_cache = {}
+        self.approximate = mode == 'approximate' or (mode == 'auto' and len(df) > APPROX_ROW_THRESHOLD)
+    
+    @property
+    def sample(self) -> pd.DataFrame:
+        """Campione casuale uniforme (riproducibile) delle righe, o l'intero DataFrame in modalità esatta"""
+        if not self.approximate or len(self.df) <= APPROX_SAMPLE_ROWS:
+            return self.df
+        if 'sample' not in self.analysis_cache:
+            rng = np.random.default_rng(0)
+            positions = np.sort(rng.choice(len(self.df), size=APPROX_SAMPLE_ROWS, replace=False))
+            self.analysis_cache['sample'] = self.df.iloc[positions]
+        return self.analysis_cache['sample']
+    
+    def _sample_scale(self) -> float:
+        """Fattore per riportare un conteggio sul campione all'intero DataFrame"""
+        return len(self.df) / max(len(self.sample), 1)
     
     def get_comprehensive_summary(self) -> Dict[str, Any]:
         """Genera un summary completo del dataset per l'AI"""
@@ -21,7 +287,15 @@ class DataAnalyzer:
             'column_analysis': self._analyze_columns(),
             'data_quality': self._assess_data_quality(),
             'relationships': self._find_relationships(),
-            'insights': self._generate_insights()
+            'insights': self._generate_insights(),
+            'profiling': {
+                'mode': 'approximate' if self.approximate else 'exact',
+                'sample_rows': len(self.sample),
+                # Valori stimati (su campione o con hash) invece che calcolati esattamente
+                'estimated_fields': ['memory_usage', 'unique_count', 'duplicate_rows', 'top_values',
+                                     'median', 'std', 'q25', 'q75', 'skewness', 'kurtosis',
+                                     'outliers_count', 'text_characteristics'] if self.approximate else []
+            }
         }
         
         self.analysis_cache['comprehensive_summary'] = summary
@@ -31,27 +305,66 @@ class DataAnalyzer:
         """Informazioni base del dataset"""
         return {
             'shape': self.df.shape,
-            'memory_usage': f"{self.df.memory_usage(deep=True).sum() / 1024**2:.2f} MB",
+            'memory_usage': f"{self._memory_usage() / 1024**2:.2f} MB",
             'columns': list(self.df.columns),
             'dtypes': {col: str(dtype) for col, dtype in self.df.dtypes.items()}
         }
     
+    def _memory_usage(self) -> float:
+        """Memoria occupata in byte (in modalità approssimata le stringhe sono misurate sul campione)"""
+        if not self.approximate:
+            return self.df.memory_usage(deep=True).sum()
+        sample_bytes = self.sample.memory_usage(deep=True, index=False).sum()
+        return sample_bytes * self._sample_scale() + self.df.index.memory_usage(deep=True)
+    
+    def _column_hashes(self, position: int) -> np.ndarray:
+        """Hash dei valori della colonna in posizione `position`, calcolati una sola volta (distinti e duplicati)"""
+        column_hashes = self.analysis_cache.setdefault('column_hashes', {})
+        if position not in column_hashes:
+            column_hashes[position] = _hash_values(self.df.iloc[:, position])
+        return column_hashes[position]
+    
+    def _column_counts(self) -> Tuple[pd.Series, pd.Series]:
+        """Conteggi di valori mancanti e distinti per tutte le colonne, calcolati una sola volta sull'intero DataFrame"""
+        if 'column_counts' not in self.analysis_cache:
+            missing_counts = self.df.isna().sum()
+            if self.approximate:
+                # Distinti stimati con HyperLogLog sugli hash dei valori non mancanti
+                unique_counts = pd.Series([_approx_distinct_count(self._column_hashes(i)[self.df.iloc[:, i].notna().to_numpy()])
+                                           for i in range(self.df.shape[1])],
+                                          index=self.df.columns, dtype=np.int64)
+                self.analysis_cache['column_counts'] = (missing_counts, unique_counts)
+                return self.analysis_cache['column_counts']
+            
+            numeric_stats = self._numeric_statistics()
+            # I distinti delle colonne numeriche arrivano già dal profilo vettorializzato
+            other_cols = [col for col in self.df.columns if col not in numeric_stats]
+            unique_counts = pd.Series(0, index=self.df.columns, dtype=np.int64)
+            if other_cols:
+                unique_counts[other_cols] = self.df[other_cols].nunique()
+            for col, stats in numeric_stats.items():
+                unique_counts[col] = stats['unique']
+            self.analysis_cache['column_counts'] = (missing_counts, unique_counts)
+        return self.analysis_cache['column_counts']
+    
     def _analyze_columns(self) -> Dict[str, Dict[str, Any]]:
         """Analisi dettagliata per ogni colonna"""
         analysis = {}
+        missing_counts, unique_counts = self._column_counts()
+        numeric_profile = self._profile_numeric_columns()
         
         for col in self.df.columns:
             col_analysis = {
                 'dtype': str(self.df[col].dtype),
-                'missing_count': int(self.df[col].isna().sum()),
-                'missing_percentage': round(self.df[col].isna().sum() / len(self.df) * 100, 2),
-                'unique_count': int(self.df[col].nunique()),
-                'unique_percentage': round(self.df[col].nunique() / len(self.df) * 100, 2)
+                'missing_count': int(missing_counts[col]),
+                'missing_percentage': round(missing_counts[col] / len(self.df) * 100, 2),
+                'unique_count': int(unique_counts[col]),
+                'unique_percentage': round(unique_counts[col] / len(self.df) * 100, 2)
             }
             
             # Analisi specifica per tipo di dato
-            if pd.api.types.is_numeric_dtype(self.df[col]):
-                col_analysis.update(self._analyze_numeric_column(col))
+            if col in numeric_profile:
+                col_analysis.update(numeric_profile[col])
             elif pd.api.types.is_datetime64_any_dtype(self.df[col]):
                 col_analysis.update(self._analyze_datetime_column(col))
             else:
@@ -61,25 +374,77 @@ class DataAnalyzer:
         
         return analysis
     
-    def _analyze_numeric_column(self, col: str) -> Dict[str, Any]:
-        """Analisi specifica per colonne numeriche"""
-        series = self.df[col].dropna()
+    def _numeric_statistics(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Statistiche grezze di tutte le colonne numeriche, calcolate in blocchi 2-D float con una sola
+        passata NumPy per blocco (vedi _numeric_block_statistics) invece di più passate per colonna.
+        """
+        if 'numeric_statistics' in self.analysis_cache:
+            return self.analysis_cache['numeric_statistics']
         
-        return {
-            'statistics': {
-                'mean': round(series.mean(), 4),
-                'median': round(series.median(), 4),
-                'std': round(series.std(), 4),
-                'min': series.min(),
-                'max': series.max(),
-                'q25': round(series.quantile(0.25), 4),
-                'q75': round(series.quantile(0.75), 4),
-                'skewness': round(series.skew(), 4),
-                'kurtosis': round(series.kurtosis(), 4)
-            },
-            'outliers_count': self._count_outliers(series),
-            'distribution_type': self._identify_distribution(series)
-        }
+        numeric_cols = [col for col in self.df.columns if pd.api.types.is_numeric_dtype(self.df[col])]
+        numeric_stats = {}
+        source = self.sample
+        
+        # Limito la dimensione del blocco per non materializzare in float64 un intero foglio molto largo
+        block_width = max(1, _NUMERIC_BLOCK_CELLS // max(len(source), 1))
+        for start in range(0, len(numeric_cols), block_width):
+            block_cols = numeric_cols[start:start + block_width]
+            block = source[block_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+            stats = _numeric_block_statistics(block)
+            
+            if self.approximate:
+                # Conteggi, minimo, massimo e media restano esatti (economici sull'intero DataFrame)
+                full = self.df[block_cols]
+                stats['count'] = full.count().to_numpy(dtype=np.float64)
+                stats['min'] = full.min().to_numpy(dtype=np.float64, na_value=np.nan)
+                stats['max'] = full.max().to_numpy(dtype=np.float64, na_value=np.nan)
+                stats['mean'] = np.round(full.mean().to_numpy(dtype=np.float64, na_value=np.nan), 4)
+                stats['outliers_count'] = np.round(stats['outliers_count'] * self._sample_scale())
+            
+            for j, col in enumerate(block_cols):
+                numeric_stats[col] = {name: values[j] for name, values in stats.items()}
+            
+            # Interi: distinti, minimo e massimo calcolati sul tipo originale (il blocco float64 serve solo per
+            # momenti e quantili: oltre 2^53 valori diversi diventano lo stesso float)
+            integer_cols = [col for col in block_cols if pd.api.types.is_integer_dtype(self.df[col].dtype)]
+            if integer_cols:
+                full = self.df[integer_cols]
+                minimum, maximum = full.min(), full.max()
+                unique = None if self.approximate else full.nunique()
+                for col in integer_cols:
+                    numeric_stats[col]['min'], numeric_stats[col]['max'] = minimum[col], maximum[col]
+                    if unique is not None:
+                        numeric_stats[col]['unique'] = unique[col]
+        
+        self.analysis_cache['numeric_statistics'] = numeric_stats
+        return numeric_stats
+    
+    def _profile_numeric_columns(self) -> Dict[str, Dict[str, Any]]:
+        """Analisi specifica per colonne numeriche, a partire dalle statistiche vettorializzate"""
+        profile = {}
+        
+        for col, stats in self._numeric_statistics().items():
+            dtype_type = self.df[col].dtype.type
+            has_values = stats['count'] > 0
+            profile[col] = {
+                'statistics': {
+                    'mean': stats['mean'],
+                    'median': stats['median'],
+                    'std': stats['std'],
+                    # min/max mantengono il tipo originale della colonna (es. interi)
+                    'min': dtype_type(stats['min']) if has_values else np.nan,
+                    'max': dtype_type(stats['max']) if has_values else np.nan,
+                    'q25': stats['q25'],
+                    'q75': stats['q75'],
+                    'skewness': stats['skewness'],
+                    'kurtosis': stats['kurtosis']
+                },
+                'outliers_count': int(stats['outliers_count']),
+                'distribution_type': self._identify_distribution(stats['skewness'], stats['kurtosis'])
+            }
+        
+        return profile
     
     def _analyze_datetime_column(self, col: str) -> Dict[str, Any]:
         """Analisi specifica per colonne datetime"""
@@ -96,28 +461,23 @@ class DataAnalyzer:
     
     def _analyze_categorical_column(self, col: str) -> Dict[str, Any]:
         """Analisi specifica per colonne categoriche"""
-        series = self.df[col].dropna()
-        value_counts = series.value_counts()
+        series = self.sample[col].dropna()
+        # A parità di frequenza vale l'ordine di prima comparsa: il contesto inviato al modello resta identico a ogni calcolo
+        top_values = series.value_counts(sort=False).sort_values(ascending=False, kind="stable").head(10)
+        top_values = top_values[top_values > 0]  # Le colonne category riportano anche le categorie assenti
+        if self.approximate:
+            top_values = (top_values * self._sample_scale()).round().astype(np.int64)
+        missing_counts, unique_counts = self._column_counts()
         
         return {
-            'top_values': value_counts.head(10).to_dict(),
-            'cardinality_level': self._assess_cardinality(series),
-            'text_characteristics': self._analyze_text_characteristics(series) if series.dtype == 'object' else None
+            'top_values': top_values.to_dict(),
+            'cardinality_level': self._assess_cardinality(unique_counts[col], len(self.df) - missing_counts[col]),
+            'text_characteristics': self._analyze_text_characteristics(series) if _is_text_dtype(series.dtype) else None
         }
     
-    def _count_outliers(self, series: pd.Series) -> int:
-        """Conta gli outlier usando IQR method"""
-        Q1 = series.quantile(0.25)
-        Q3 = series.quantile(0.75)
-        IQR = Q3 - Q1
-        lower_bound = Q1 - 1.5 * IQR
-        upper_bound = Q3 + 1.5 * IQR
-        return int(((series < lower_bound) | (series > upper_bound)).sum())
-    
-    def _identify_distribution(self, series: pd.Series) -> str:
-        """Identifica il tipo di distribuzione approssimativo"""
-        skew = abs(series.skew())
-        kurt = series.kurtosis()
+    def _identify_distribution(self, skew: float, kurt: float) -> str:
+        """Identifica il tipo di distribuzione approssimativo a partire da skewness e kurtosis"""
+        skew = abs(skew)
         
         if skew < 0.5:
             if -0.5 <= kurt <= 0.5:
@@ -140,9 +500,9 @@ class DataAnalyzer:
             'weekday_pattern': series.dt.day_name().value_counts().to_dict()
         }
     
-    def _assess_cardinality(self, series: pd.Series) -> str:
-        """Valuta il livello di cardinalità"""
-        unique_ratio = series.nunique() / len(series)
+    def _assess_cardinality(self, unique_count: int, non_missing_count: int) -> str:
+        """Valuta il livello di cardinalità (valori distinti rispetto ai valori non mancanti)"""
+        unique_ratio = unique_count / non_missing_count if non_missing_count else 0
         
         if unique_ratio > 0.95:
             return "alta_cardinalita"
@@ -156,45 +516,55 @@ class DataAnalyzer:
     def _analyze_text_characteristics(self, series: pd.Series) -> Dict[str, Any]:
         """Analizza caratteristiche del testo"""
         text_lengths = series.astype(str).str.len()
+        scale = self._sample_scale()
         
         return {
             'avg_length': round(text_lengths.mean(), 2),
             'max_length': int(text_lengths.max()),
-            'contains_numbers': int(series.astype(str).str.contains(r'\d').sum()),
-            'contains_special_chars': int(series.astype(str).str.contains(r'[^\w\s]').sum())
+            'contains_numbers': int(round(series.astype(str).str.contains(r'\d').sum() * scale)),
+            'contains_special_chars': int(round(series.astype(str).str.contains(r'[^\w\s]').sum() * scale))
         }
     
     def _assess_data_quality(self) -> Dict[str, Any]:
         """Valuta la qualità generale dei dati"""
         total_cells = self.df.size
-        missing_cells = self.df.isna().sum().sum()
+        missing_counts, _ = self._column_counts()
+        missing_cells = missing_counts.sum()
         
         return {
             'completeness_score': round((1 - missing_cells / total_cells) * 100, 2),
-            'duplicate_rows': int(self.df.duplicated().sum()),
-            'columns_with_missing': int((self.df.isna().sum() > 0).sum()),
+            'duplicate_rows': self._count_duplicate_rows(),
+            'columns_with_missing': int((missing_counts > 0).sum()),
             'data_quality_issues': self._identify_quality_issues()
         }
     
+    def _count_duplicate_rows(self) -> int:
+        """Righe duplicate: esatte, oppure stimate come righe con hash già visto (collisioni trascurabili)"""
+        if not self.approximate:
+            return int(self.df.duplicated().sum())
+        # Hash di riga combinando gli hash (già calcolati) delle singole colonne
+        row_hashes = np.zeros(len(self.df), dtype=np.uint64)
+        for position in range(self.df.shape[1]):
+            row_hashes = row_hashes * np.uint64(0x100000001B3) ^ self._column_hashes(position)
+        return int(len(row_hashes) - len(np.unique(row_hashes)))
+    
     def _identify_quality_issues(self) -> List[str]:
         """Identifica problemi di qualità dei dati"""
         issues = []
+        missing_counts, unique_counts = self._column_counts()
         
         # Check for completely empty columns
-        empty_cols = self.df.columns[self.df.isna().all()].tolist()
+        empty_cols = self.df.columns[(missing_counts == len(self.df)).to_numpy()].tolist()
         if empty_cols:
             issues.append(f"Colonne completamente vuote: {empty_cols}")
         
         # Check for columns with very high missing rate
-        high_missing = self.df.columns[self.df.isna().sum() / len(self.df) > 0.8].tolist()
+        high_missing = self.df.columns[(missing_counts / len(self.df) > 0.8).to_numpy()].tolist()
         if high_missing:
             issues.append(f"Colonne con >80% valori mancanti: {high_missing}")
         
         # Check for potential constant columns
-        constant_cols = []
-        for col in self.df.columns:
-            if self.df[col].nunique() == 1:
-                constant_cols.append(col)
+        constant_cols = self.df.columns[(unique_counts == 1).to_numpy()].tolist()
         if constant_cols:
             issues.append(f"Colonne con valore costante: {constant_cols}")
         
@@ -212,20 +582,10 @@ class DataAnalyzer:
         
         # Correlazioni numeriche
         if len(numeric_cols) > 1:
-            corr_matrix = self.df[numeric_cols].corr()
-            
-            for i in range(len(numeric_cols)):
-                for j in range(i+1, len(numeric_cols)):
-                    corr_val = corr_matrix.iloc[i, j]
-                    if abs(corr_val) > 0.7:
-                        relationships['high_correlations'].append({
-                            'col1': numeric_cols[i],
-                            'col2': numeric_cols[j],
-                            'correlation': round(corr_val, 3)
-                        })
+            relationships['high_correlations'] = self._correlation_matrix().high_correlations(threshold=0.7)
         
         # Potenziali gerarchie (es: città-provincia-regione)
-        text_cols = self.df.select_dtypes(include=['object']).columns
+        text_cols = self.df.select_dtypes(include=_TEXT_DTYPES).columns
         for i, col1 in enumerate(text_cols):
             for col2 in text_cols[i+1:]:
                 if self._check_hierarchy(col1, col2):
@@ -236,14 +596,49 @@ class DataAnalyzer:
         
         return relationships
     
+    def _correlation_matrix(self) -> 'CorrelationMatrix':
+        """Matrice di correlazione delle colonne numeriche, calcolata una sola volta e riusata dalle query"""
+        if 'correlation_matrix' not in self.analysis_cache:
+            numeric_cols = self.df.select_dtypes(include=[np.number]).columns
+            self.analysis_cache['correlation_matrix'] = CorrelationMatrix(numeric_cols).update(self.df)
+        return self.analysis_cache['correlation_matrix']
+    
+    def append_rows(self, rows: pd.DataFrame) -> None:
+        """
+        Aggiunge righe al DataFrame analizzato: la matrice di correlazione viene aggiornata
+        incrementalmente, le altre analisi verranno ricalcolate alla prossima richiesta.
+        """
+        self.df = pd.concat([self.df, rows], ignore_index=True)
+        correlation = self.analysis_cache.get('correlation_matrix')
+        self.analysis_cache = {}
+        if correlation is not None:
+            self.analysis_cache['correlation_matrix'] = correlation.update(rows)
+    
+    def _factorized_column(self, col: str) -> Tuple[np.ndarray, int]:
+        """Codici interi della colonna (-1 = mancante) e numero di valori distinti, calcolati una sola volta"""
+        factorized = self.analysis_cache.setdefault('factorized_columns', {})
+        if col not in factorized:
+            try:
+                codes, uniques = pd.factorize(self.df[col])
+                factorized[col] = (codes, len(uniques))
+            except TypeError:
+                # Valori non hashabili (liste, dict, ...): la colonna non può partecipare a gerarchie
+                factorized[col] = None
+        return factorized[col]
+    
     def _check_hierarchy(self, col1: str, col2: str) -> bool:
         """Verifica se esiste una relazione gerarchica tra due colonne"""
         # Semplice euristica: se ogni valore di col1 corrisponde a un solo valore di col2
-        try:
-            grouped = self.df.groupby(col1)[col2].nunique()
-            return (grouped == 1).all() and self.df[col1].nunique() > self.df[col2].nunique()
-        except:
+        child, parent = self._factorized_column(col1), self._factorized_column(col2)
+        if child is None or parent is None:
+            return False
+        
+        child_codes, child_cardinality = child
+        parent_codes, parent_cardinality = parent
+        # Potatura per cardinalità: il figlio deve avere più valori distinti del padre
+        if child_cardinality <= parent_cardinality:
             return False
+        return _is_functional_dependency(child_codes, parent_codes, child_cardinality)
     
     def _generate_insights(self) -> List[str]:
         """Genera insights automatici sui dati"""
@@ -257,7 +652,7 @@ class DataAnalyzer:
             insights.append(f"Dataset piccolo con solo {rows} righe")
         
         # Insight sui valori mancanti
-        missing_pct = (self.df.isna().sum().sum() / self.df.size) * 100
+        missing_pct = (self._column_counts()[0].sum() / self.df.size) * 100
         if missing_pct > 20:
             insights.append(f"Attenzione: {missing_pct:.1f}% di valori mancanti nel dataset")
         elif missing_pct == 0:
@@ -337,6 +732,9 @@ class DataAnalyzer:
                 pd.api.types.is_numeric_dtype(self.df[col2])):
             raise ValueError("Both columns must be numeric for correlation")
         
+        correlation = self._correlation_matrix()
+        if col1 in correlation.columns and col2 in correlation.columns:
+            return correlation.matrix.loc[col1, col2]
         return self.df[col1].corr(self.df[col2])
     
     def _get_distribution(self, column: str, bins: int = 10) -> Dict[str, Any]:
@@ -357,25 +755,40 @@ class DataAnalyzer:
                 'value_counts': value_counts.to_dict()
             }
 
+def _get_summary(df: pd.DataFrame, fingerprint: str, mode: str) -> Dict[str, Any]:
+    return _summary_cache.get_or_compute((fingerprint, mode), lambda: DataAnalyzer(df, mode=mode).get_comprehensive_summary())
+
+def get_data_summary(df: pd.DataFrame, mode: str = 'auto') -> Dict[str, Any]:
+    """Restituisce il summary completo del dataset, calcolato una sola volta per contenuto (da non modificare)"""
+    return _get_summary(df, dataframe_fingerprint(df), mode)
+
 # Funzione helper per creare il prompt context
-def create_data_context(df: pd.DataFrame) -> str:
-    """Crea il contesto sui dati per l'AI"""
-    analyzer = DataAnalyzer(df)
-    summary = analyzer.get_comprehensive_summary()
+def create_data_context(df: pd.DataFrame, mode: str = 'auto') -> str:
+    """Crea il contesto sui dati per l'AI (memorizzato per impronta del DataFrame)"""
+    fingerprint = dataframe_fingerprint(df)
+    return _context_cache.get_or_compute((fingerprint, mode),
+                                         lambda: _render_data_context(_get_summary(df, fingerprint, mode)))
+
+def _render_data_context(summary: Dict[str, Any]) -> str:
+    """Rende il summary come testo per il prompt (le stime della modalità approssimata sono precedute da ~)"""
+    estimated = set(summary['profiling']['estimated_fields'])
+    est = lambda field: "~" if field in estimated else ""
     
     context = f"""
 CONTESTO DATASET:
 - Dimensioni: {summary['basic_info']['shape'][0]} righe × {summary['basic_info']['shape'][1]} colonne
-- Memoria: {summary['basic_info']['memory_usage']}
+- Memoria: {est('memory_usage')}{summary['basic_info']['memory_usage']}
 - Completezza: {summary['data_quality']['completeness_score']}%
-- Righe duplicate: {summary['data_quality']['duplicate_rows']}
-
-COLONNE DISPONIBILI:
+- Righe duplicate: {est('duplicate_rows')}{summary['data_quality']['duplicate_rows']}
 """
+    if summary['profiling']['mode'] == 'approximate':
+        context += (f"- Profilazione approssimata su un campione di {summary['profiling']['sample_rows']} righe: "
+                    f"i valori preceduti da ~ sono stime\n")
+    context += "\nCOLONNE DISPONIBILI:\n"
     
     for col, info in summary['column_analysis'].items():
         context += f"\n• {col} ({info['dtype']}): "
-        context += f"{info['unique_count']} valori unici, "
+        context += f"{est('unique_count')}{info['unique_count']} valori unici, "
         context += f"{info['missing_percentage']}% mancanti"
         
         if 'statistics' in info:
@@ -0,0 +1,121 @@
+import csv
+import hashlib
+import importlib.util
+import io
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from cache import LRUCache
+
+# Memoria massima occupata dai fogli già letti, condivisi tra le sessioni (variabile d'ambiente)
+SHEET_CACHE_MB = int(os.environ.get("SHEET_CACHE_MB", 1024))
+
+# Formati accettati dagli uploader
+SUPPORTED_FILE_TYPES = ["xlsx", "csv", "parquet"]
+
+# Motore di lettura Excel: calamine (Rust, molto più veloce) se installato, altrimenti openpyxl
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+_HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+def _frame_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+# Fogli già convertiti in DataFrame (con i tipi originali), indicizzati per (hash del contenuto del file, nome del foglio)
+_sheet_cache = LRUCache(max_entries=64, max_bytes=SHEET_CACHE_MB * 1024**2, sizeof=_frame_size)
+# Tempi e memoria della lettura di ogni foglio
+_load_stats = LRUCache(max_entries=64)
+# Cartelle di lavoro aperte (con il lock che ne serializza la lettura): nomi dei fogli e lettura usano lo stesso handle
+_workbook_cache = LRUCache(max_entries=8)
+# Hash del contenuto dei file caricati, per non ricalcolarlo a ogni rerun di Streamlit
+_content_hashes = LRUCache(max_entries=64)
+
+
+def file_content_hash(uploaded_file: Any) -> str:
+    """Hash del contenuto di un file caricato (memorizzato per file_id del caricamento Streamlit)"""
+    file_id = getattr(uploaded_file, "file_id", None)
+    compute = lambda: hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+    if file_id is None:
+        return compute()
+    return _content_hashes.get_or_compute(file_id, compute)
+
+
+def _file_type(uploaded_file: Any) -> str:
+    return os.path.splitext(getattr(uploaded_file, "name", ""))[1].lower().lstrip(".") or "xlsx"
+
+
+def _open_workbook(uploaded_file: Any, content_hash: str) -> Tuple[pd.ExcelFile, threading.Lock]:
+    return _workbook_cache.get_or_compute(
+        content_hash, lambda: (pd.ExcelFile(io.BytesIO(uploaded_file.getvalue()), engine=EXCEL_ENGINE), threading.Lock()))
+
+
+def _read_csv(data: bytes) -> pd.DataFrame:
+    """
+    Legge un CSV riconoscendo il separatore (, ; tab |), con il parser pyarrow se disponibile.
+    I file separati da ; (Excel in italiano) usano la virgola per i decimali e il punto per le migliaia:
+    vengono letti con il parser C, l'unico che gestisce il separatore delle migliaia.
+    """
+    sample = data[:65536].decode("utf-8", errors="ignore")
+    try:
+        separator = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        separator = ","
+    options = {"decimal": ",", "thousands": "."} if separator == ";" else {}
+    engine = "pyarrow" if _HAS_PYARROW and not options else "c"
+    try:
+        return pd.read_csv(io.BytesIO(data), sep=separator, engine=engine, **options)
+    except (UnicodeDecodeError, ValueError):
+        # File non UTF-8 (es. esportati da Excel in cp1252) o non gestibili dal parser pyarrow
+        return pd.read_csv(io.BytesIO(data), sep=separator, encoding="latin-1", **options)
+
+
+def _read_table(uploaded_file: Any, content_hash: str, sheet_name: str) -> pd.DataFrame:
+    file_type = _file_type(uploaded_file)
+    if file_type == "csv":
+        return _read_csv(uploaded_file.getvalue())
+    if file_type == "parquet":
+        return pd.read_parquet(io.BytesIO(uploaded_file.getvalue()))
+    workbook, lock = _open_workbook(uploaded_file, content_hash)
+    with lock:
+        return workbook.parse(sheet_name)
+
+
+def _load(uploaded_file: Any, content_hash: str, sheet_name: str) -> pd.DataFrame:
+    start = time.perf_counter()
+    df = _read_table(uploaded_file, content_hash, sheet_name)
+    read_time = time.perf_counter() - start
+    _load_stats.put((content_hash, sheet_name), {
+        "engine": EXCEL_ENGINE if _file_type(uploaded_file) == "xlsx" else _file_type(uploaded_file),
+        "read_seconds": read_time,
+        "total_seconds": time.perf_counter() - start,
+        "memory": _frame_size(df),
+    })
+    return df
+
+
+def get_sheet_names(uploaded_file: Any) -> List[str]:
+    """Nomi dei fogli del file Excel caricato (la cartella di lavoro viene aperta una sola volta); per CSV e Parquet un unico foglio"""
+    if _file_type(uploaded_file) in ("csv", "parquet"):
+        return [os.path.splitext(uploaded_file.name)[0]]
+    return _open_workbook(uploaded_file, file_content_hash(uploaded_file))[0].sheet_names
+
+
+def load_sheet(uploaded_file: Any, sheet_name: str) -> pd.DataFrame:
+    """
+    Restituisce il foglio richiesto con i tipi originali delle colonne, leggendolo una sola volta per contenuto del file:
+    i rerun di Streamlit e le altre sessioni che caricano lo stesso file riusano lo stesso DataFrame,
+    che quindi va trattato in sola lettura.
+    """
+    content_hash = file_content_hash(uploaded_file)
+    return _sheet_cache.get_or_compute((content_hash, sheet_name)
+                                       , lambda: _load(uploaded_file, content_hash, sheet_name))
+
+
+def get_load_stats(uploaded_file: Any, sheet_name: str) -> Optional[Dict[str, Any]]:
+    """Tempi di lettura e memoria del foglio (None se non disponibili)"""
+    return _load_stats.get((file_content_hash(uploaded_file), sheet_name))
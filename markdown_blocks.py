@@ -0,0 +1,147 @@
+import re
+from typing import List, NamedTuple, Tuple, Union
+
+# Riconoscimento dei blocchi (espressioni compilate una volta sola; nessun quantificatore annidato)
+_TABLE_ROW = re.compile(r"^\|.+\|\s*$")
+_TABLE_SEPARATOR = re.compile(r"^\|\s*[-:]+\s*(\|\s*[-:]+\s*)+\|\s*$")
+_CODE_FENCE = re.compile(r"^\s*(```|~~~)\s*([\w+-]*)")
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_LIST_ITEM = re.compile(r"^\s*(?:([-*+])|(\d+)[.)])\s+(.*)$")
+# Numeri nelle celle: 1234 / -12.5 (notazione Python) oppure 1.234,5 / 12,5 / 1.234.567 (notazione italiana).
+# Gli zeri iniziali (es. codici ISTAT) e i numeri con più di 15 cifre restano testo
+_AMBIGUOUS_NUMBER = re.compile(r"^-?[1-9]\d{0,2}[.,]\d{3}$")  # 12.500 / 3,000: migliaia o decimali?
+_PLAIN_NUMBER = re.compile(r"^-?(?:0|[1-9]\d{0,14})(?:\.\d+)?$")
+_ITALIAN_NUMBER = re.compile(r"^-?(?:0|[1-9]\d{0,2}(?:\.\d{3})*|[1-9]\d{0,14}),\d+$|^-?[1-9]\d{0,2}(?:\.\d{3}){2,}$")
+# Formattazione inline: **grassetto**, `codice`, *corsivo* / _corsivo_
+_INLINE = re.compile(r"\*\*(.+?)\*\*|`([^`]+)`|\*([^*\s][^*]*?)\*|\b_([^_\s][^_]*?)_\b")
+
+
+class Block(NamedTuple):
+    """
+    Blocco di un messaggio markdown: kind è "text", "table", "code" o "latex".
+    source è il testo originale del blocco; per le tabelle header e rows contengono le celle già separate,
+    per il codice language è il linguaggio indicato dopo ```.
+    """
+    kind: str
+    source: str
+    header: Tuple[str, ...] = ()
+    rows: Tuple[Tuple[str, ...], ...] = ()
+    language: str = ""
+
+
+def split_table_row(line: str) -> Tuple[str, ...]:
+    """Celle di una riga di tabella markdown ("| a | b |" -> ("a", "b"))"""
+    return tuple(cell.strip() for cell in line.strip().strip("|").split("|"))
+
+
+def typed_cell(text: str) -> Union[str, int, float]:
+    """
+    Valore di una cella di tabella: int o float se il testo è un numero, altrimenti il testo invariato.
+    Un solo separatore seguito da esattamente tre cifre (12.500, 3,000) può indicare le migliaia in entrambe
+    le notazioni: la cella resta testo per non esportare un numero sbagliato.
+    """
+    if _AMBIGUOUS_NUMBER.match(text):
+        return text
+    if _PLAIN_NUMBER.match(text):
+        return float(text) if "." in text else int(text)
+    if _ITALIAN_NUMBER.match(text):
+        number = text.replace(".", "").replace(",", ".")
+        return float(number) if "." in number else int(number)
+    return text
+
+
+def parse_blocks(content: str) -> List[Block]:
+    """
+    Suddivide il testo markdown di un messaggio in blocchi tipizzati con una sola passata sulle righe:
+    tabelle (header + separatore + righe che iniziano con |), blocchi di codice ```, formule $$...$$ o \\[...\\]
+    su righe proprie, e testo per tutto il resto.
+    """
+    lines = content.splitlines()
+    blocks: List[Block] = []
+    text: List[str] = []
+
+    def flush_text():
+        if text:
+            blocks.append(Block("text", "\n".join(text)))
+            text.clear()
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+
+        if stripped.startswith("|") and i + 1 < len(lines) and _TABLE_ROW.match(line) and _TABLE_SEPARATOR.match(lines[i + 1]):
+            flush_text()
+            j = i + 2
+            while j < len(lines) and lines[j].strip().startswith("|"):
+                j += 1
+            blocks.append(Block("table", "\n".join(lines[i:j])
+                                , header=split_table_row(line)
+                                , rows=tuple(split_table_row(row) for row in lines[i + 2:j])))
+            i = j
+            continue
+
+        fence = _CODE_FENCE.match(line)
+        if fence:
+            j = i + 1
+            while j < len(lines) and not lines[j].strip().startswith(fence.group(1)):
+                j += 1
+            if j < len(lines):
+                flush_text()
+                blocks.append(Block("code", "\n".join(lines[i:j + 1]), language=fence.group(2)))
+                i = j + 1
+                continue
+
+        closing = "$$" if stripped.startswith("$$") else "\\]" if stripped.startswith("\\[") else None
+        if closing:
+            j = i
+            # La formula può aprirsi e chiudersi sulla stessa riga ($$x$$) o proseguire sulle successive
+            if not (len(stripped) > 2 and stripped.endswith(closing)):
+                j = i + 1
+                while j < len(lines) and not lines[j].strip().endswith(closing):
+                    j += 1
+            if j < len(lines):
+                flush_text()
+                blocks.append(Block("latex", "\n".join(lines[i:j + 1])))
+                i = j + 1
+                continue
+
+        text.append(line)
+        i += 1
+
+    flush_text()
+    return blocks
+
+
+def parse_inline(text: str) -> List[Tuple[str, str]]:
+    """Segmenti (stile, testo) di una riga: stile è "", "bold", "italic" o "code" """
+    segments = []
+    position = 0
+    for match in _INLINE.finditer(text):
+        if match.start() > position:
+            segments.append(("", text[position:match.start()]))
+        bold, code, italic, underscore_italic = match.groups()
+        if bold is not None:
+            segments.append(("bold", bold))
+        elif code is not None:
+            segments.append(("code", code))
+        else:
+            segments.append(("italic", italic if italic is not None else underscore_italic))
+        position = match.end()
+    if position < len(text):
+        segments.append(("", text[position:]))
+    return segments
+
+
+def heading_level(line: str) -> Tuple[int, str]:
+    """(livello, testo) per i titoli markdown (# ... ######), (0, riga) altrimenti"""
+    match = _HEADING.match(line)
+    return (len(match.group(1)), match.group(2).strip()) if match else (0, line)
+
+
+def list_item(line: str) -> Tuple[str, str]:
+    """("bullet" o "number", testo) per gli elementi di elenco, ("", riga) altrimenti"""
+    match = _LIST_ITEM.match(line)
+    if not match:
+        return "", line
+    return ("bullet" if match.group(1) else "number"), match.group(3)
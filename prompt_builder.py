@@ -0,0 +1,142 @@
+import hashlib
+import importlib.util
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Budget di token del prompt: finestra di contesto del modello meno i token riservati alla risposta
+# (PROMPT_TOKEN_BUDGET, se impostata, vale per tutti i modelli, es. per contenere i costi)
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 0))
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+}
+DEFAULT_CONTEXT_WINDOW = 128_000
+RESERVED_OUTPUT_TOKENS = 32_768     # Lunghezza massima della risposta dei modelli GPT-4.1
+
+RECENT_MESSAGES = 6             # Ultimi messaggi (3 scambi) inviati sempre per intero
+OLDER_MESSAGE_TOKENS = 200      # Lunghezza massima dei messaggi più vecchi
+TOOL_RESULT_TOKENS = 4000       # Lunghezza massima del risultato di execute_code inviato al modello
+
+# Overhead di formattazione per messaggio e per l'avvio della risposta (formato chat di OpenAI)
+_MESSAGE_OVERHEAD = 3
+_REPLY_OVERHEAD = 3
+_FALLBACK_ENCODING = "o200k_base"   # Tokenizer dei modelli GPT-4.1 / GPT-4o
+_HAS_TIKTOKEN = importlib.util.find_spec("tiktoken") is not None
+
+_encodings: Dict[str, Any] = {}
+_tokenizer_warning_logged = False
+# Conteggi già calcolati, indicizzati per (tokenizer, hash del testo): la cronologia viene ricontata a ogni turno
+_token_counts = LRUCache(max_entries=4096)
+
+
+def _get_encoding(model: str) -> Any:
+    """Tokenizer tiktoken del modello (None se tiktoken non è installato o i suoi dati non sono disponibili)"""
+    global _tokenizer_warning_logged
+    if model not in _encodings:
+        encoding = None
+        if _HAS_TIKTOKEN:
+            import tiktoken
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    # Modello non ancora noto alla versione installata di tiktoken
+                    encoding = tiktoken.get_encoding(_FALLBACK_ENCODING)
+            except Exception as e:
+                # Il file del tokenizer viene scaricato al primo uso: senza rete si ripiega sulla stima
+                if not _tokenizer_warning_logged:
+                    logger.warning("Tokenizer non disponibile, conteggio dei token stimato dai caratteri (%s)", e)
+                    _tokenizer_warning_logged = True
+        _encodings[model] = encoding
+    return _encodings[model]
+
+
+def get_token_budget(model: str) -> int:
+    """Token massimi del prompt per il modello: finestra di contesto meno i token riservati alla risposta"""
+    return PROMPT_TOKEN_BUDGET or MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) - RESERVED_OUTPUT_TOKENS
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Token del testo con il tokenizer del modello (senza tiktoken: stima di 4 caratteri per token)"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    key = (encoding.name, hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest())
+    return _token_counts.get_or_compute(key, lambda: len(encoding.encode(text, disallowed_special=())))
+
+
+def count_message_tokens(messages: List[Dict[str, Any]], model: str) -> int:
+    """Token di una lista di messaggi chat, overhead di formattazione incluso"""
+    return sum(_MESSAGE_OVERHEAD + count_tokens(str(message.get("content") or ""), model) for message in messages) + _REPLY_OVERHEAD
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """Tronca il testo a max_tokens token, segnalando al modello la parte omessa"""
+    total = count_tokens(text, model)
+    if total <= max_tokens:
+        return text
+    encoding = _get_encoding(model)
+    if encoding is None:
+        kept = text[:max_tokens * 4]
+    else:
+        kept = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return f"{kept}\n[... testo troncato: circa {total - max_tokens} token omessi]"
+
+
+def truncate_tool_result(content: str, model: str) -> str:
+    """Limita la lunghezza del risultato di una function call (es. tabelle con migliaia di righe)"""
+    return truncate_to_tokens(content, TOOL_RESULT_TOKENS, model)
+
+
+def build_messages(system_content: str
+                   , history: List[Dict[str, Any]]
+                   , model: str
+                   , metrics: Optional[Dict[str, Any]] = None
+                   , budget: Optional[int] = None) -> List[Dict[str, str]]:
+    """
+    Compone i messaggi della richiesta entro il budget di token del modello:
+    - i messaggi della cronologia vengono copiati con i soli campi role/content;
+    - solo se il budget viene superato, i messaggi precedenti agli ultimi RECENT_MESSAGES vengono accorciati a
+      OLDER_MESSAGE_TOKENS token (sempre allo stesso modo, così il testo di un messaggio già compattato non cambia
+      nei turni successivi), tranne il primo messaggio dell'utente, che contiene descrizione dei dati e istruzioni;
+    - se il budget viene comunque superato si scartano gli scambi più vecchi, mantenendo almeno l'ultimo messaggio.
+    Se passato, metrics viene popolato con i token del prompt inviato ("prompt_tokens"), di quello che si sarebbe
+    inviato senza compattazione ("prompt_tokens_full") e con i messaggi esclusi per il budget ("dropped_messages").
+    """
+    budget = budget or get_token_budget(model)
+    system_message = {"role": "system", "content": system_content}
+    messages = [{"role": message["role"], "content": str(message.get("content") or "")} for message in history]
+    full_tokens = count_message_tokens([system_message] + messages, model)
+
+    tokens = full_tokens
+    if tokens > budget:
+        first_user = next((message for message in messages if message["role"] == "user"), None)
+        for message in messages[:max(0, len(messages) - RECENT_MESSAGES)]:
+            if message is not first_user:
+                message["content"] = truncate_to_tokens(message["content"], OLDER_MESSAGE_TOKENS, model)
+        tokens = count_message_tokens([system_message] + messages, model)
+    dropped_messages = 0
+    while tokens > budget and len(messages) > 1:
+        # Scarto il messaggio più vecchio e le risposte che lo seguono: la cronologia riparte da un messaggio utente
+        dropped = [messages.pop(0)]
+        while len(messages) > 1 and messages[0]["role"] != "user":
+            dropped.append(messages.pop(0))
+        tokens -= count_message_tokens(dropped, model) - _REPLY_OVERHEAD
+        dropped_messages += len(dropped)
+    if dropped_messages:
+        logger.warning("Prompt oltre il budget di %d token per %s: esclusi i %d messaggi meno recenti",
+                       budget, model, dropped_messages)
+
+    if metrics is not None:
+        metrics["prompt_tokens"] = tokens
+        metrics["prompt_tokens_full"] = full_tokens
+        metrics["dropped_messages"] = dropped_messages
+    return [system_message] + messages
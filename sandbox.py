@@ -0,0 +1,282 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+from cache import LRUCache, dataframe_fingerprint
+from code_result import CodeResult
+from utils import code_cache_key, execute_code
+
+try:
+    import resource  # Limiti di CPU e memoria: disponibili solo su sistemi POSIX
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Configurazione del pool (variabili d'ambiente)
+SANDBOX_ENABLED = os.environ.get("SANDBOX_ENABLED", "1") != "0"
+SANDBOX_WORKERS = int(os.environ.get("SANDBOX_WORKERS", 2))
+SANDBOX_TIMEOUT_SECONDS = float(os.environ.get("SANDBOX_TIMEOUT_SECONDS", 30))
+SANDBOX_CPU_SECONDS = int(os.environ.get("SANDBOX_CPU_SECONDS", 20))
+SANDBOX_MEMORY_MB = int(os.environ.get("SANDBOX_MEMORY_MB", 4096))  # 0 = nessun limite
+RESULT_CACHE_ENTRIES = int(os.environ.get("RESULT_CACHE_ENTRIES", 256))
+RESULT_CACHE_MB = int(os.environ.get("RESULT_CACHE_MB", 64))
+
+# Cartella (per processo) dei DataFrame condivisi con i worker come file Arrow memory-mapped
+_DATA_DIR = os.path.join(tempfile.gettempdir(), f"storylaizer_sandbox_{os.getpid()}")
+# DataFrame mantenuti su disco dal processo principale e in memoria da ogni worker
+_PUBLISHED_FRAMES = 16
+_WORKER_FRAMES = 2
+_MISSING = object()
+
+
+class CPUTimeExceeded(Exception):
+    """Sollevata nel worker quando il codice supera il tempo di CPU concesso"""
+
+
+def _on_cpu_limit(signum, frame):
+    raise CPUTimeExceeded("Tempo di CPU massimo superato: semplifica l'elaborazione o filtra i dati prima di elaborarli.")
+
+
+def _load_frame(path: str) -> pd.DataFrame:
+    if path.endswith(".arrow"):
+        from pyarrow import feather
+        return feather.read_table(path, memory_map=True).to_pandas()
+    return pd.read_pickle(path)
+
+
+def _worker_main(conn, cpu_seconds: int, memory_mb: int) -> None:
+    """Ciclo del processo worker: riceve (impronta, percorso dati, codice) e restituisce il risultato di execute_code"""
+    # I DataFrame restano in memoria tra le chiamate di tutte le sessioni: con Copy-on-Write le modifiche
+    # sul posto fatte dal codice generato restano locali alla chiamata (il worker non importa app.py)
+    pd.set_option("mode.copy_on_write", True)
+    if resource is not None:
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+        if memory_mb:
+            # Il limite sullo spazio di indirizzamento è l'unico limite di memoria applicato dal kernel
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024**2, hard))
+
+    frames = OrderedDict()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        fingerprint, path, code = task
+        try:
+            if fingerprint not in frames:
+                frames[fingerprint] = _load_frame(path)
+                while len(frames) > _WORKER_FRAMES:
+                    frames.popitem(last=False)
+            frames.move_to_end(fingerprint)
+
+            if resource is not None and cpu_seconds:
+                # Limite relativo al tempo di CPU già consumato dal worker
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+                resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + cpu_seconds, hard))
+            result = execute_code(code, frames[fingerprint])
+        except (MemoryError, CPUTimeExceeded) as e:
+            result = {"error": str(e) or "Memoria insufficiente per completare l'elaborazione.", "code": code}
+        except Exception as e:
+            result = {"error": str(e), "code": code}
+        finally:
+            if resource is not None and cpu_seconds:
+                _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+                resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+        try:
+            conn.send(result)
+        except Exception as e:
+            # Risultato non serializzabile: restituisco la sua rappresentazione testuale
+            conn.send({"error": f"Risultato non trasferibile: {e}", "result": str(result)})
+
+
+class SandboxPool:
+    """
+    Pool di processi worker pre-avviati (pandas/numpy già importati) che eseguono il codice generato dal
+    modello fuori dal processo del server Streamlit, con limiti di tempo CPU, memoria e timeout.
+    Il DataFrame viene scritto una sola volta (per contenuto) in un file Arrow letto in memory-map dai worker.
+    """
+
+    def __init__(self
+                 , workers: int = SANDBOX_WORKERS
+                 , timeout: float = SANDBOX_TIMEOUT_SECONDS
+                 , cpu_seconds: int = SANDBOX_CPU_SECONDS
+                 , memory_mb: int = SANDBOX_MEMORY_MB):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("forkserver")
+            # I worker nascono dal fork di un processo che ha già importato le librerie pesanti
+            self._context.set_forkserver_preload(["pandas", "numpy", "utils", "sandbox"])
+        else:
+            self._context = multiprocessing.get_context("spawn")
+        self._published = OrderedDict()
+        self._publish_lock = threading.Lock()
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(self._start_worker())
+        os.makedirs(_DATA_DIR, exist_ok=True)
+
+    def _start_worker(self) -> Tuple[Any, Any]:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main
+                                        , args=(child_conn, self.cpu_seconds, self.memory_mb)
+                                        , daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def _publish(self, df: pd.DataFrame, fingerprint: Optional[str] = None) -> Tuple[str, str]:
+        """Scrive il DataFrame su file una sola volta per contenuto; restituisce (impronta, percorso)"""
+        fingerprint = fingerprint or dataframe_fingerprint(df)
+        with self._publish_lock:
+            path = self._published.get(fingerprint)
+            if path is not None:
+                self._published.move_to_end(fingerprint)
+            if path is None or not os.path.exists(path):
+                path = os.path.join(_DATA_DIR, f"{fingerprint}.arrow")
+                tmp_path = f"{path}.tmp"
+                try:
+                    df.to_feather(tmp_path, compression="uncompressed")
+                except Exception:
+                    # Tipi non rappresentabili in Arrow (es. colonne con tipi misti): ripiego su pickle
+                    path = os.path.join(_DATA_DIR, f"{fingerprint}.pkl")
+                    tmp_path = f"{path}.tmp"
+                    df.to_pickle(tmp_path)
+                os.replace(tmp_path, path)
+                self._published[fingerprint] = path
+                while len(self._published) > _PUBLISHED_FRAMES:
+                    _, evicted_path = self._published.popitem(last=False)
+                    try:
+                        os.remove(evicted_path)
+                    except OSError:
+                        pass
+        return fingerprint, path
+
+    def run(self, code: str, df: pd.DataFrame, fingerprint: Optional[str] = None) -> Any:
+        """Esegue il codice su df in un worker e restituisce lo stesso risultato (o dict di errore) di execute_code"""
+        fingerprint, path = self._publish(df, fingerprint)
+        process, conn = worker = self._idle.get()
+        try:
+            conn.send((fingerprint, path, code))
+            if conn.poll(self.timeout):
+                return conn.recv()
+            # Timeout: il worker viene terminato e sostituito
+            process.kill()
+            process.join()
+            worker = self._start_worker()
+            return {"error": f"Tempo massimo di esecuzione ({self.timeout:.0f} s) superato: semplifica l'elaborazione o filtra i dati.",
+                    "code": code}
+        except (EOFError, OSError):
+            # Worker terminato (es. dal kernel per il limite di memoria)
+            process.kill()
+            process.join()
+            worker = self._start_worker()
+            return {"error": "L'esecuzione del codice è stata interrotta (memoria o risorse insufficienti).", "code": code}
+        finally:
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        """Termina i worker e rimuove i file dei DataFrame condivisi"""
+        while not self._idle.empty():
+            process, conn = self._idle.get_nowait()
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+        shutil.rmtree(_DATA_DIR, ignore_errors=True)
+
+
+def _result_size(value: Any) -> int:
+    """Occupazione stimata di un risultato: memoria della tabella per i CodeResult tabellari, altrimenti del valore"""
+    if isinstance(value, CodeResult):
+        if value.is_table:
+            return int(value.table.memory_usage(index=True, deep=True).sum())
+        value = value.value
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+# Risultati già calcolati, indicizzati per (impronta del DataFrame, AST normalizzato del codice)
+_result_cache = LRUCache(max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_MB * 1024**2, sizeof=_result_size)
+
+
+def invalidate_results(df: pd.DataFrame) -> int:
+    """Elimina i risultati memorizzati per il DataFrame (es. quando l'utente seleziona un altro foglio)"""
+    fingerprint = dataframe_fingerprint(df)
+    return _result_cache.discard_where(lambda key: key[0] == fingerprint)
+
+
+def result_cache_stats() -> Dict[str, int]:
+    """Contatori della cache dei risultati: hit, miss, voci e occupazione in byte"""
+    return {"hits": _result_cache.hits, "misses": _result_cache.misses
+            , "entries": len(_result_cache), "bytes": _result_cache.total_bytes}
+
+
+_pool: Optional[SandboxPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool() -> SandboxPool:
+    """Pool condiviso dal processo, avviato alla prima richiesta"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+            atexit.register(_pool.close)
+    return _pool
+
+
+def run_code(code: str, df: pd.DataFrame) -> Any:
+    """
+    Esegue il codice generato dal modello nel pool di worker isolati (se abilitato con SANDBOX_ENABLED),
+    altrimenti direttamente con execute_code nel processo corrente.
+    Lo stesso calcolo sullo stesso DataFrame restituisce il risultato memorizzato senza rieseguire il codice.
+    """
+    fingerprint = dataframe_fingerprint(df)
+    code_key = code_cache_key(code)
+    if code_key is not None:
+        cached = _result_cache.get((fingerprint, code_key), _MISSING)
+        if cached is not _MISSING:
+            return cached
+
+    if not SANDBOX_ENABLED:
+        result = execute_code(code, df)
+    else:
+        try:
+            pool = get_sandbox_pool()
+        except Exception as e:
+            logger.warning("Sandbox non disponibile, esecuzione nel processo corrente (%s)", e)
+            pool = None
+        result = pool.run(code, df, fingerprint) if pool is not None else execute_code(code, df)
+
+    # Gli errori (timeout, limiti di risorse, ...) non vengono memorizzati
+    if code_key is not None and not (isinstance(result, dict) and "error" in result):
+        _result_cache.put((fingerprint, code_key), result)
+    return result
@@ -0,0 +1,119 @@
+import csv
+import io
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from cache import LRUCache, dataframe_fingerprint
+from prompt_builder import count_tokens
+
+# Cifre significative dei decimali inviati al modello (gli interi non vengono mai arrotondati)
+TABLE_SIGNIFICANT_DIGITS = 6
+# Il formato con legenda (valori sostituiti da codici) viene scelto solo se riduce i token almeno di questa frazione
+DICTIONARY_MIN_SAVING = 0.1
+
+_FORMAT_DESCRIPTIONS = {
+    "csv": "Formato: CSV con intestazione (separatore virgola).",
+    "tsv": "Formato: valori separati da tabulazione, con intestazione.",
+    "dizionario": ("Formato: valori separati da tabulazione, con intestazione; nelle colonne con legenda "
+                   "i numeri sono codici da sostituire con il valore corrispondente."),
+}
+
+# Tabelle già serializzate, indicizzate per (impronta del DataFrame, modello)
+_serialized_tables = LRUCache(max_entries=32)
+
+
+def format_float(value: float) -> str:
+    """Decimale con al più TABLE_SIGNIFICANT_DIGITS cifre significative, senza notazione esponenziale"""
+    if abs(value) >= 10 ** TABLE_SIGNIFICANT_DIGITS:
+        return f"{value:.0f}"
+    return np.format_float_positional(value, precision=TABLE_SIGNIFICANT_DIGITS, unique=True, fractional=False, trim="-")
+
+
+def format_column(series: pd.Series) -> List[str]:
+    """Valori della colonna come testo: decimali arrotondati, date senza orario se sempre a mezzanotte, mancanti vuoti"""
+    missing = series.isna().to_numpy()
+    if pd.api.types.is_float_dtype(series.dtype):
+        # Formatto i valori nel loro tipo originale: un float32 non diventa 0.10000000149011612
+        values = series.to_numpy()
+        return ["" if is_missing else format_float(value) for value, is_missing in zip(values, missing)]
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        date_only = (series.dropna() == series.dropna().dt.normalize()).all()
+        series = series.dt.strftime("%Y-%m-%d" if date_only else "%Y-%m-%d %H:%M:%S")
+    return ["" if is_missing else " ".join(str(value).split()) for value, is_missing in zip(series.to_numpy(), missing)]
+
+
+def _prepare(df: pd.DataFrame) -> Tuple[List[str], List[List[str]], List[bool], List[str]]:
+    """Restituisce (nomi delle colonne, valori testuali per colonna, colonne di testo, righe descrittive delle colonne costanti)"""
+    names, columns, text_columns, constants = [], [], [], []
+    for position in range(df.shape[1]):
+        name = str(df.columns[position])
+        values = format_column(df.iloc[:, position])
+        if len(values) > 1 and len(set(values)) == 1:
+            # Colonna con lo stesso valore in tutte le righe: la riporto una sola volta
+            constants.append(f"{name} = {values[0] or '(vuoto)'}")
+            continue
+        names.append(name)
+        columns.append(values)
+        text_columns.append(not pd.api.types.is_numeric_dtype(df.dtypes.iloc[position])
+                            and not pd.api.types.is_datetime64_any_dtype(df.dtypes.iloc[position]))
+    return names, columns, text_columns, constants
+
+
+def _to_csv(names: List[str], columns: List[List[str]]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(names)
+    writer.writerows(zip(*columns))
+    return buffer.getvalue().rstrip("\n")
+
+
+def _to_tsv(names: List[str], columns: List[List[str]]) -> str:
+    return "\n".join("\t".join(row) for row in [names] + list(zip(*columns)))
+
+
+def _to_dictionary(names: List[str], columns: List[List[str]], text_columns: List[bool]) -> str:
+    """Sostituisce i valori ripetuti delle colonne di testo con codici numerici, quando la legenda accorcia la colonna"""
+    legends, encoded = [], []
+    for name, values, is_text in zip(names, columns, text_columns):
+        if not is_text:
+            encoded.append(values)
+            continue
+        distinct = list(dict.fromkeys(value for value in values if value))
+        codes = {value: str(code) for code, value in enumerate(distinct, start=1)}
+        legend = f"Legenda {name}: " + "; ".join(f"{code}={value}" for value, code in codes.items())
+        if distinct and len(legend) + sum(len(codes.get(value, "")) for value in values) < sum(len(value) for value in values):
+            legends.append(legend)
+            values = [codes.get(value, "") for value in values]
+        encoded.append(values)
+    return "\n".join(legends + [_to_tsv(names, encoded)])
+
+
+def _serialize(df: pd.DataFrame, model: str) -> str:
+    names, columns, text_columns, constants = _prepare(df)
+    candidates: Dict[str, str] = {"csv": _to_csv(names, columns), "tsv": _to_tsv(names, columns)}
+    tokens = {name: count_tokens(text, model) for name, text in candidates.items()}
+    chosen = min(tokens, key=tokens.get)
+
+    dictionary = _to_dictionary(names, columns, text_columns)
+    if count_tokens(dictionary, model) <= tokens[chosen] * (1 - DICTIONARY_MIN_SAVING):
+        chosen, candidates["dizionario"] = "dizionario", dictionary
+
+    lines = [_FORMAT_DESCRIPTIONS[chosen]]
+    if constants:
+        lines.append("Colonne con lo stesso valore in tutte le righe (omesse dalla tabella): " + "; ".join(constants))
+    lines.append(candidates[chosen])
+    return "\n".join(lines)
+
+
+def serialize_table(df: pd.DataFrame, model: str, use_cache: bool = True) -> str:
+    """
+    Testo compatto della tabella da includere nei prompt, al posto di df.to_markdown():
+    tra CSV, TSV e TSV con legenda dei valori ripetuti sceglie il formato con meno token per il modello,
+    arrotonda i decimali a TABLE_SIGNIFICANT_DIGITS cifre significative e riporta a parte le colonne costanti.
+    Con use_cache il risultato viene memorizzato per contenuto del DataFrame (un foglio viene serializzato una volta sola).
+    """
+    if not use_cache:
+        return _serialize(df, model)
+    return _serialized_tables.get_or_compute((dataframe_fingerprint(df), model), lambda: _serialize(df, model))
@@ -0,0 +1,21 @@
+from cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert "a" in cache and "c" in cache and "b" not in cache
+
+
+def test_oversized_value_is_kept_alone():
+    cache = LRUCache(max_entries=8, max_bytes=10, sizeof=len)
+    cache.put("small", "x" * 4)
+    cache.put("big", "x" * 50)
+    assert cache.get("big") == "x" * 50
+    assert "small" not in cache
+    assert len(cache) == 1 and cache.total_bytes == 50
+    cache.put("next", "x" * 4)
+    assert "big" not in cache and cache.total_bytes == 4
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_analyzer import CorrelationMatrix, DataAnalyzer, _approx_distinct_count, _hash_values, _numeric_block_statistics
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(42)
+    n = 500
+    frame = pd.DataFrame({
+        "a": rng.normal(10, 3, n),
+        "b": rng.integers(0, 20, n),
+        "c": rng.exponential(2, n),
+        "regione": rng.choice(["Lazio", "Sicilia", "Molise"], n),
+    })
+    frame["d"] = frame["a"] * 2 + rng.normal(0, 1, n)
+    frame.loc[rng.choice(n, 40, replace=False), "a"] = np.nan
+    frame.loc[rng.choice(n, 25, replace=False), "c"] = np.nan
+    return frame
+
+
+def test_numeric_block_statistics_match_pandas(df):
+    columns = ["a", "b", "c", "d"]
+    stats = _numeric_block_statistics(df[columns].to_numpy(dtype=np.float64, na_value=np.nan))
+    for j, col in enumerate(columns):
+        series = df[col]
+        assert stats["count"][j] == series.count()
+        assert stats["unique"][j] == series.nunique()
+        assert stats["min"][j] == series.min()
+        assert stats["max"][j] == series.max()
+        assert stats["mean"][j] == pytest.approx(round(series.mean(), 4))
+        assert stats["median"][j] == pytest.approx(round(series.median(), 4))
+        assert stats["std"][j] == pytest.approx(round(series.std(), 4))
+        assert stats["q25"][j] == pytest.approx(round(series.quantile(0.25), 4))
+        assert stats["q75"][j] == pytest.approx(round(series.quantile(0.75), 4))
+        assert stats["skewness"][j] == pytest.approx(round(series.skew(), 4))
+        assert stats["kurtosis"][j] == pytest.approx(round(series.kurt(), 4))
+        iqr = series.quantile(0.75) - series.quantile(0.25)
+        outliers = ((series < series.quantile(0.25) - 1.5 * iqr) | (series > series.quantile(0.75) + 1.5 * iqr)).sum()
+        assert stats["outliers_count"][j] == outliers
+
+
+def test_numeric_block_statistics_degenerate_columns():
+    block = np.array([[1.0, np.nan, 5.0], [np.nan, np.nan, 5.0], [2.0, np.nan, 5.0]])
+    stats = _numeric_block_statistics(block)
+    assert stats["count"].tolist() == [2, 0, 3]
+    assert stats["unique"].tolist() == [2, 0, 1]
+    assert np.isnan(stats["mean"][1]) and np.isnan(stats["median"][1])
+    assert np.isnan(stats["skewness"][0])  # Meno di 3 valori
+    assert stats["skewness"][2] == pd.Series([5.0] * 3).skew()
+    assert _numeric_block_statistics(np.empty((0, 2)))["count"].tolist() == [0, 0]
+
+
+def test_approx_distinct_count():
+    rng = np.random.default_rng(0)
+    small = pd.Series(rng.integers(0, 100, 10_000))
+    assert abs(_approx_distinct_count(_hash_values(small)) - small.nunique()) <= 1
+    large = pd.Series(rng.integers(0, 10**12, 200_000))
+    assert _approx_distinct_count(_hash_values(large)) == pytest.approx(large.nunique(), rel=0.03)
+    assert _approx_distinct_count(np.array([], dtype=np.uint64)) == 0
+
+
+def test_approximate_mode_matches_exact_counts(df):
+    df = pd.concat([df, df.iloc[:30]], ignore_index=True)
+    approximate = DataAnalyzer(df, mode="approximate")
+    assert approximate._count_duplicate_rows() == df.duplicated().sum()
+    _, unique_counts = approximate._column_counts()
+    for col in df.columns:
+        assert abs(unique_counts[col] - df[col].nunique()) <= max(1, df[col].nunique() * 0.02)
+
+
+def test_correlation_matrix_matches_pandas(df):
+    columns = ["a", "b", "c", "d"]
+    expected = df[columns].corr()
+    pd.testing.assert_frame_equal(CorrelationMatrix(columns).update(df).matrix, expected)
+    # Aggiornamento incrementale a blocchi: stesso risultato del calcolo sull'intero DataFrame
+    incremental = CorrelationMatrix(columns, block_rows=64)
+    for start in range(0, len(df), 150):
+        incremental.update(df.iloc[start:start + 150])
+    pd.testing.assert_frame_equal(incremental.matrix, expected)
+    pairs = {(item["col1"], item["col2"]) for item in incremental.high_correlations(0.7)}
+    assert pairs == {("a", "d")}
+
+
+def test_correlation_matrix_after_append_rows(df):
+    analyzer = DataAnalyzer(df.iloc[:300], mode="exact")
+    analyzer.get_comprehensive_summary()
+    analyzer.append_rows(df.iloc[300:])
+    numeric = df.select_dtypes(include=[np.number])
+    pd.testing.assert_frame_equal(analyzer._correlation_matrix().matrix, numeric.corr())
+
+
+def test_exact_summary_matches_pandas(df):
+    df = df.assign(big=np.arange(len(df), dtype=np.int64) + 2**60)  # Distinti oltre la precisione del float64
+    summary = DataAnalyzer(df, mode="exact").get_comprehensive_summary()
+    columns = summary["column_analysis"]
+    for col in df.columns:
+        assert columns[col]["unique_count"] == df[col].nunique()
+        assert columns[col]["missing_count"] == df[col].isna().sum()
+    statistics = columns["b"]["statistics"]
+    assert statistics["min"] == df["b"].min() and statistics["max"] == df["b"].max()
+    assert statistics["std"] == pytest.approx(round(df["b"].std(), 4))
+    assert columns["big"]["statistics"]["max"] == df["big"].max()
+    assert summary["data_quality"]["duplicate_rows"] == df.duplicated().sum()
+    assert summary["profiling"]["mode"] == "exact"
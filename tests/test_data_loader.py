@@ -0,0 +1,23 @@
+import pandas as pd
+
+from data_loader import _read_csv
+
+
+def test_semicolon_csv_with_decimal_comma_is_numeric():
+    data = "Regione;Quota;Popolazione\nLazio;12,5;1.234.567\nSicilia;3;5.000\nMolise;;7\n".encode("utf-8")
+    df = _read_csv(data)
+    assert pd.api.types.is_float_dtype(df["Quota"])
+    assert df["Quota"].tolist()[:2] == [12.5, 3.0]
+    assert df["Popolazione"].tolist() == [1234567, 5000, 7]
+
+
+def test_semicolon_csv_in_latin1():
+    data = "Comune;Quota\nForlì;1,5\n".encode("latin-1")
+    df = _read_csv(data)
+    assert df.loc[0, "Comune"] == "Forlì"
+    assert df.loc[0, "Quota"] == 1.5
+
+
+def test_comma_csv_keeps_decimal_point():
+    df = _read_csv(b"a,b\n1.5,x\n2.25,y\n")
+    assert df["a"].tolist() == [1.5, 2.25]
@@ -0,0 +1,29 @@
+import pytest
+
+from markdown_blocks import typed_cell
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("1234", 1234),
+    ("-12.5", -12.5),
+    ("0.500", 0.5),
+    ("1234.500", 1234.5),
+    ("1.234,5", 1234.5),
+    ("12,5", 12.5),
+    ("5.720.000", 5720000),
+    ("1.234.567,89", 1234567.89),
+])
+def test_typed_cell_numbers(text, expected):
+    value = typed_cell(text)
+    assert value == expected
+    assert type(value) is type(expected)
+
+
+@pytest.mark.parametrize("text", [
+    # Un solo separatore seguito da tre cifre: migliaia o decimali, resta testo
+    "12.500", "3,000", "1,234", "-12.500",
+    # Zeri iniziali e testo
+    "007", "Lazio", "",
+])
+def test_typed_cell_keeps_text(text):
+    assert typed_cell(text) == text
@@ -0,0 +1,42 @@
+from prompt_builder import OLDER_MESSAGE_TOKENS, RECENT_MESSAGES, build_messages, count_message_tokens, count_tokens
+
+MODEL = "gpt-4.1-nano"
+
+
+def _history(turns, long_text):
+    history = [{"role": "user", "content": "Descrizione dei dati ed esempio di report: " + long_text}]
+    for turn in range(turns):
+        history.append({"role": "assistant", "content": f"Report {turn}: " + long_text})
+        history.append({"role": "user", "content": f"Domanda {turn}"})
+    return history
+
+
+def test_history_is_sent_verbatim_below_budget():
+    history = _history(5, "testo " * 2000)
+    messages = build_messages("sistema", history, MODEL)
+    assert [message["content"] for message in messages[1:]] == [message["content"] for message in history]
+
+
+def test_older_messages_are_compacted_over_budget_except_first_user_message():
+    history = _history(5, "testo " * 2000)
+    metrics = {}
+    # Budget appena sotto il prompt completo: basta la compattazione, nessun messaggio scartato
+    budget = count_message_tokens([{"role": "system", "content": "sistema"}] + history, MODEL) - 1
+    messages = build_messages("sistema", history, MODEL, metrics, budget=budget)
+    assert messages[1]["content"] == history[0]["content"]
+    older = messages[2:len(messages) - RECENT_MESSAGES]
+    assert older and all(count_tokens(message["content"], MODEL) <= OLDER_MESSAGE_TOKENS + 20 for message in older)
+    assert [message["content"] for message in messages[-RECENT_MESSAGES:]] == [message["content"] for message in history[-RECENT_MESSAGES:]]
+    assert metrics["prompt_tokens"] < metrics["prompt_tokens_full"]
+    assert metrics["dropped_messages"] == 0
+
+
+def test_oldest_exchanges_are_dropped_when_compaction_is_not_enough():
+    history = _history(5, "testo " * 2000)
+    metrics = {}
+    budget = count_tokens(history[-1]["content"] + history[-2]["content"], MODEL) + 100
+    messages = build_messages("sistema", history, MODEL, metrics, budget=budget)
+    assert metrics["prompt_tokens"] <= budget
+    assert metrics["dropped_messages"] > 0
+    assert messages[1]["role"] == "user"
+    assert messages[-1] == history[-1]
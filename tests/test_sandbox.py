@@ -0,0 +1,20 @@
+import pandas as pd
+import pytest
+
+from sandbox import SandboxPool
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = SandboxPool(workers=1, timeout=60, cpu_seconds=0, memory_mb=0)
+    yield pool
+    pool.close()
+
+
+def test_worker_frame_is_not_modified_by_code(pool):
+    # Lo stesso worker conserva il DataFrame tra le chiamate: una modifica sul posto non deve arrivare alle successive
+    df = pd.DataFrame({"x": [1, 2, 3, 4]})
+    pool.run("df.loc[0, 'x'] = 999\nresult = df.loc[0, 'x']", df)
+    pool.run("df['x'] += 1000\nresult = df['x'].sum()", df)
+    assert pool.run("result = df.loc[0, 'x']", df).value == 1
+    assert pool.run("result = df['x'].sum()", df).value == 10
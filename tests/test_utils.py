@@ -0,0 +1,93 @@
+import pandas as pd
+import pytest
+
+from utils import ColumnResolver, _compile_snippet, code_cache_key
+
+
+def _reference_find_column(columns, key):
+    """Algoritmo originale di CIDataFrame._find_column (scansione lineare delle colonne)"""
+    col_map = {}
+    for col in columns:
+        col_lower = str(col).lower()
+        col_map[col_lower] = col
+        if col_lower.endswith('e'):
+            col_map[col_lower[:-1] + 'i'] = col
+        elif col_lower.endswith('a'):
+            col_map[col_lower[:-1] + 'e'] = col
+        elif col_lower.endswith('o'):
+            col_map[col_lower[:-1] + 'i'] = col
+        elif col_lower.endswith('i'):
+            col_map[col_lower[:-1] + 'e'] = col
+            col_map[col_lower[:-1] + 'o'] = col
+    key_lower = key.lower()
+    if key_lower in col_map:
+        return col_map[key_lower]
+    normalize = lambda text: text.replace(' ', '').replace('_', '').replace('-', '')
+    key_normalized = normalize(key_lower)
+    for col in columns:
+        if key_normalized == normalize(str(col).lower()):
+            return col
+    for col in columns:
+        col_lower = str(col).lower()
+        col_normalized = normalize(col_lower)
+        if (key_lower in col_lower or col_lower in key_lower
+                or key_normalized in col_normalized or col_normalized in key_normalized):
+            return col
+    key_words = set(key_lower.split())
+    for col in columns:
+        if len(key_words & set(str(col).lower().split())) >= len(key_words) * 0.5:
+            return col
+    return key
+
+
+COLUMNS = ["Regione", "Provincia", "Numero Abitanti", "prodotti_venduti", "Data-Vendita",
+           "Prezzo medio (EUR)", "Anno", "Regioni", "ab", "Valore Totale Vendite"]
+KEYS = ["regione", "REGIONI", "province", "numero_abitanti", "NumeroAbitanti", "abitanti", "prodotto venduto",
+        "prodottivenduti", "data vendita", "prezzo", "anno di riferimento", "totale vendite 2024", "xyz",
+        "valore vendite", "a", "", "prezzo medio (eur)", "Prezzo Medio", "anni", "Vendite Totale Valore"]
+
+
+@pytest.mark.parametrize("key", KEYS)
+def test_column_resolver_matches_reference(key):
+    assert ColumnResolver(COLUMNS).resolve(key) == _reference_find_column(COLUMNS, key)
+
+
+def test_column_resolver_with_long_keys_and_many_columns():
+    columns = [f"colonna {i} misura" for i in range(300)] + ["ricavi netti"]
+    resolver = ColumnResolver(columns)
+    for key in ["ricavi", "Colonna 42 Misura", "colonna 299", "misura", "x" * 200, "ricavi netti " * 20]:
+        assert resolver.resolve(key) == _reference_find_column(columns, key)
+
+
+def test_compile_snippet_strips_fences_and_captures_last_expression():
+    source, code, last_assigned, error, key = _compile_snippet("```python\nimport pandas as pd\ndf['x'].sum()\n```")
+    assert error is None and last_assigned is None
+    assert "```" not in source
+    namespace = {"df": pd.DataFrame({"x": [1, 2, 3]}), "pd": pd}
+    exec(code, namespace)
+    assert namespace["__last_expression__"] == 6
+
+    _, _, last_assigned, _, _ = _compile_snippet("totale = df['x'].sum()")
+    assert last_assigned == "totale"
+
+
+def test_compile_snippet_rejects_forbidden_imports():
+    for code in ["import os\nos.listdir('.')", "from pathlib import Path", "import numpy as numpy"]:
+        _, compiled, _, error, _ = _compile_snippet(code)
+        assert compiled is None and error.startswith("Import vietato")
+
+
+def test_compile_snippet_strips_markdown_only_from_invalid_code():
+    _, code, _, _, _ = _compile_snippet("result = 2 ** 3")
+    namespace = {}
+    exec(code, namespace)
+    assert namespace["result"] == 8
+    source, _, _, _, _ = _compile_snippet("result = **df**['x'].sum()")
+    assert source == "result = df['x'].sum()"
+
+
+def test_result_key_ignores_formatting_and_skips_non_deterministic_code():
+    assert code_cache_key("result = df['x'].sum()  # totale") == code_cache_key("result=df[ 'x' ].sum()")
+    assert code_cache_key("result = df['x'].sum()") != code_cache_key("result = df['x'].mean()")
+    assert code_cache_key("result = df.sample(3)") is None
+    assert code_cache_key("result = (") is None
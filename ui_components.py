@@ -1,8 +1,23 @@
 import streamlit as st
 import re
+import time
 import pandas as pd
-from utils import reset_conversation, export_chat
-from api import get_api_key, ask_openai_analysis, ask_openai_report
+import numpy as np
+from utils import reset_conversation, export_chat, conversation_signature
+from data_analyzer import get_data_summary
+from api import get_api_key, ask_openai_analysis_async, ask_openai_report_async, generate_row_reports, submit, stream_sync
+from sandbox import result_cache_stats
+from cache import dataframe_fingerprint
+
+# Pattern per le formule LaTeX: $$...$$, $...$ (ma non singoli $ isolati), \[...\]
+LATEX_PATTERN = r'(\$\$[^$]+\$\$|\$[^$\s][^$]*[^$\s]\$|\\\[[^\]]*\\\])'
+
+# Righe per pagina nell'anteprima dei dati caricati
+PREVIEW_PAGE_ROWS = 100
+
+def _format_count(value: int) -> str:
+    """Numero intero con il punto come separatore delle migliaia"""
+    return f"{value:,}".replace(",", ".")
 
 def handle_chat_input(key, chat_history):
     """Gestisce l'input della chat con una chiave univoca"""
@@ -21,35 +36,79 @@ def handle_chat_input(key, chat_history):
         with st.chat_message("assistant"):
             loading_placeholder = st.empty()
             loading_placeholder.markdown("🧠 *Storylaizer sta scrivendo...*")
+            streaming = st.session_state.get("streaming", True)
+            metrics = {}
+            results = []
+            # Le richieste girano sull'event loop condiviso e vengono annullate dal reset della conversazione
+            owner = st.session_state.session_id
 
             # Scelgo il DataFrame e la funzione di OpenAI in base alla tab (key)
             if key == "1": # Se siamo nel tab 1 e la domanda contiene analisi dati, facciamo function-calling 
-                risposta = ask_openai_analysis(history = chat_history
+                richiesta = ask_openai_analysis_async(history = chat_history
                                             , model = st.session_state.get("selected_model", "gpt-4.1-nano")
                                             , df = st.session_state.get("dataframe", None)
                                             , temperature = st.session_state.get("temperature", 0.7)
                                             , top_p = st.session_state.get("top_p", 1.0)
+                                            , stream = streaming
+                                            , metrics = metrics
+                                            , results = results
                                             )
             elif key == "2": # Nel tab 2 non deve fare function-calling, ma solo report
-                risposta = ask_openai_report(history = chat_history
+                richiesta = ask_openai_report_async(history = chat_history
                                              , model = st.session_state.get("selected_model", "gpt-4.1-nano") 
                                              , df = st.session_state.get("dataframe_report", None)
                                              , temperature = st.session_state.get("temperature", 0.7)
                                              , top_p = st.session_state.get("top_p", 1.0)
+                                             , stream = streaming
+                                             , metrics = metrics
                                             )
             else:  # key == "3" # Nel tab 3 non deve fare function-calling, ma solo report (ma senza dati importati da excel)
-                risposta = ask_openai_report(history = chat_history
+                richiesta = ask_openai_report_async(history = chat_history
                                              , model = st.session_state.get("selected_model", "gpt-4.1-nano") 
                                              , df = None
                                              , temperature = st.session_state.get("temperature", 0.7)
                                              , top_p = st.session_state.get("top_p", 1.0)
+                                             , stream = streaming
+                                             , metrics = metrics
                                             )
-            loading_placeholder.empty()
-            render_response(risposta)
-            chat_history.append({"role": "assistant", "content": risposta})
+            if streaming:
+                # Il placeholder mostra "sta scrivendo..." fino al primo token, poi il testo parziale
+                risposta = render_stream(stream_sync(richiesta, owner), loading_placeholder)
+            else:
+                risposta = submit(richiesta, owner).result()
+                loading_placeholder.empty()
+                render_response(risposta)
+            message = {"role": "assistant", "content": risposta}
+            # Le tabelle troncate per il modello vengono conservate complete nel messaggio, per l'interfaccia e l'esportazione
+            result_tables = [result.table for result in results if result.truncated]
+            if result_tables:
+                message["result_tables"] = result_tables
+            chat_history.append(message)
+            st.session_state[f"response_metrics{key}"] = metrics
         
         st.rerun()
     
+    # Tempi dell'ultima risposta (tempo al primo token e tempo totale) e token del prompt inviato
+    metrics = st.session_state.get(f"response_metrics{key}")
+    if metrics and "ttft" in metrics:
+        st.caption(f"⏱️ Ultima risposta: primo token dopo {metrics['ttft']:.1f} s"
+                   + (f", completata in {metrics['total_time']:.1f} s" if "total_time" in metrics else "")
+                   + (f" · prompt di {_format_count(metrics['prompt_tokens'])} token" if "prompt_tokens" in metrics else "")
+                   + (f" ({_format_count(metrics['prompt_tokens_full'])} senza compattazione)"
+                      if metrics.get("prompt_tokens_full", 0) > metrics.get("prompt_tokens", 0) else "")
+                   + (f", {_format_count(metrics['cached_tokens'])} su {_format_count(metrics['api_prompt_tokens'])}"
+                      " letti dalla cache del provider" if metrics.get("api_prompt_tokens") else ""))
+        if metrics.get("dropped_messages"):
+            st.warning(f"⚠️ La conversazione supera il budget di token del prompt: i {metrics['dropped_messages']} messaggi "
+                       "meno recenti non sono stati inviati al modello.")
+
+    # Contatori della cache dei calcoli sui dati (solo per la chat del Data Analyzer)
+    if key == "1":
+        stats = result_cache_stats()
+        if stats["hits"] or stats["misses"]:
+            st.caption(f"🗂️ Cache dei calcoli: {stats['hits']} risultati riutilizzati, {stats['misses']} calcolati"
+                       f" ({stats['entries']} in memoria, {stats['bytes'] / 1024:.0f} KB)")
+
     # Altrimenti mostra il campo input con chiave univoca
     user_input = st.chat_input("Scrivi qualcosa...", key=key)
     if user_input:
@@ -76,7 +135,7 @@ def render_response(content):
     """
     # Pattern per le formule LaTeX
     # Cattura: $$...$$, $...$ (ma non singoli $ isolati), \[...\]
-    latex_pattern = r'(\$\$[^$]+\$\$|\$[^$\s][^$]*[^$\s]\$|\\\[[^\]]*\\\])'
+    latex_pattern = LATEX_PATTERN
     
     # Dividi il contenuto in parti: testo normale e formule LaTeX
     parts = re.split(latex_pattern, content, flags=re.DOTALL)
@@ -128,6 +187,56 @@ def render_response(content):
         st.markdown(processed_content, unsafe_allow_html=True)
 
 
+def split_renderable(content):
+    """
+    Separa il testo in streaming in una parte già renderizzabile e una parte in attesa che inizia
+    con una formula LaTeX ancora aperta ($...$, $$...$$, \\[...\\]), così da non mostrarla a metà.
+    """
+    latex_pattern = LATEX_PATTERN
+    tail = re.split(latex_pattern, content, flags=re.DOTALL)[-1]
+    offset = len(content) - len(tail)
+    closers = {"$$": "$$", "$": "$", "\\[": "\\]"}
+
+    position = 0
+    while True:
+        # Un $ seguito da spazio non apre una formula (es. importi): non blocca il rendering
+        opening = re.compile(r'\$\$|\$(?=[^$\s]|$)|\\\[|\\$').search(tail, position)
+        if not opening:
+            return content, ""
+        token = opening.group()
+        # Un "\" finale potrebbe essere l'inizio di "\[": resta in attesa
+        closing = tail.find(closers[token], opening.end()) if token in closers else -1
+        if closing == -1:
+            split_at = offset + opening.start()
+            return content[:split_at], content[split_at:]
+        position = closing + len(closers[token])
+
+
+def render_stream(stream, placeholder, refresh_seconds=0.1, max_pending_chars=500):
+    """
+    Renderizza una risposta in streaming nel placeholder man mano che arrivano i token e restituisce il testo completo.
+    Le formule LaTeX aperte restano in attesa finché non vengono chiuse (oltre max_pending_chars il "$" viene
+    considerato testo normale); il rendering è limitato a un aggiornamento ogni refresh_seconds.
+    """
+    content = ""
+    last_render = 0.0
+    for delta in stream:
+        content += delta
+        if time.perf_counter() - last_render < refresh_seconds:
+            continue
+        renderable, pending = split_renderable(content)
+        if len(pending) > max_pending_chars:
+            renderable = content
+        if renderable.strip():
+            with placeholder.container():
+                render_response(renderable)
+            last_render = time.perf_counter()
+
+    with placeholder.container():
+        render_response(content)
+    return content
+
+
 def load_css():
     st.markdown("""
         <style>
@@ -207,34 +316,119 @@ def display_chat_history(chat_history):
         else:
             with st.chat_message("assistant"):
                 render_response(msg["content"])
+                render_result_tables(msg.get("result_tables", []))
+
+
+def render_result_tables(tables):
+    """Tabelle complete dei risultati dei calcoli, mostrate con il componente nativo di Streamlit"""
+    for table in tables:
+        with st.expander(f"📋 Risultato completo del calcolo ({len(table)} righe × {table.shape[1]} colonne)", expanded=False):
+            st.dataframe(table, hide_index=True)
 
 
-def render_data_preview(df):
+def _preview_statistics(df):
+    """Statistiche descrittive dell'anteprima, ricavate dal profilo del DataAnalyzer (calcolato una volta per foglio)"""
+    summary = get_data_summary(df)
+    rows = {}
+    for col, info in summary["column_analysis"].items():
+        # Statistiche solo per le colonne numeriche (escluse le booleane)
+        values = {} if pd.api.types.is_bool_dtype(df[col]) else info.get("statistics", {})
+        mean, std = values.get("mean", np.nan), values.get("std", np.nan)
+        rows[col] = {
+            "dtype": info["dtype"],
+            "missing": info["missing_count"],
+            "distinct": info["unique_count"],
+            "min": float(values.get("min", np.nan)),
+            "q1": round(values.get("q25", np.nan), 2),
+            "median": round(values.get("median", np.nan), 2),
+            "mean": round(mean, 2),
+            "q3": round(values.get("q75", np.nan), 2),
+            "max": float(values.get("max", np.nan)),
+            "std": round(std, 2),
+            "cv": round(std / mean, 2) if mean else np.nan,
+        }
+    return pd.DataFrame.from_dict(rows, orient="index"), summary["profiling"]
+
+
+def render_data_preview(df, load_stats=None, key="preview"):
     # Anteprima
     st.markdown("<div class='mode-title'>Tabella Dati</div>", unsafe_allow_html=True)
-    st.markdown(f"""**{df.shape[0]}** righe, **{df.shape[1]}** colonne""", unsafe_allow_html=True)
-    st.dataframe(df)
+    footprint = ""
+    if load_stats:
+        # Memoria del DataFrame, letto una sola volta e condiviso tra le sessioni che caricano lo stesso file
+        footprint = f", memoria **{load_stats['memory'] / 1024**2:.1f} MB** (condivisa tra le sessioni)"
+    st.markdown(f"""**{df.shape[0]}** righe, **{df.shape[1]}** colonne{footprint}""", unsafe_allow_html=True)
+
+    # Al browser viene inviata solo la pagina di righe visualizzata
+    n_pages = max(1, -(-len(df) // PREVIEW_PAGE_ROWS))
+    page = 1
+    if n_pages > 1:
+        page = st.number_input(f"Pagina (di {n_pages})", min_value=1, max_value=n_pages, value=1, step=1, key=f"{key}_page")
+    start = (page - 1) * PREVIEW_PAGE_ROWS
+    st.dataframe(df.iloc[start:start + PREVIEW_PAGE_ROWS])
+    if n_pages > 1:
+        st.caption(f"Righe {start + 1}–{min(start + PREVIEW_PAGE_ROWS, len(df))} di {len(df)}")
 
     # Statistiche principali
     st.markdown("<div class='mode-title'>Statistiche descrittive</div>", unsafe_allow_html=True)
-
-    # Costruisco il DataFrame di summary
-    stats = pd.DataFrame(index=df.columns)
-    stats["dtype"]   = df.dtypes.astype(str)
-    stats["missing"] = df.isna().sum()
-    stats["distinct"] = df.nunique()
-    # Applico solo alle colonne numeriche
-    numeric = df.select_dtypes(include="number")
-    stats["min"]    = numeric.min()
-    stats["q1"]     = numeric.quantile(0.25).round(2)
-    stats["median"] = numeric.median().round(2)
-    stats["mean"]   = numeric.mean().round(2)
-    stats["q3"]     = numeric.quantile(0.75).round(2)
-    stats["max"]    = numeric.max()
-    stats["std"]    = numeric.std().round(2)
-    stats["cv"]     = (numeric.std() / numeric.mean()).round(2)
-    # Mostro statistiche
+    stats, profiling = _preview_statistics(df)
     st.dataframe(stats)
+    if profiling["mode"] == "approximate":
+        st.caption(f"Valori mancanti, distinti e quantili stimati su un campione di {profiling['sample_rows']} righe")
+
+def render_load_stats(stats):
+    """Mostra il tempo di lettura del file (la memoria occupata è riportata nell'anteprima)"""
+    if not stats:
+        return
+    st.caption(f"⚡ Letto in {stats['read_seconds']:.1f} s (motore {stats['engine']}), "
+               f"compattato in {stats['total_seconds'] - stats['read_seconds']:.1f} s")
+
+
+def render_row_reports(df):
+    """
+    Genera un report per ciascuna riga del DataFrame con richieste parallele e mostra la tabella risultante.
+    Widget e report generati sono legati all'impronta del foglio: caricando un altro file o foglio si riparte da zero.
+    """
+    sheet_key = dataframe_fingerprint(df)
+    with st.expander("🧩 Genera un report per ogni riga", expanded=False):
+        st.markdown("""<div class='mode-subtitle'>Le righe vengono elaborate a gruppi con più richieste in parallelo: 
+                    funziona anche con tabelle di migliaia di righe. Il risultato è una tabella con due colonne 
+                    (riferimento della riga e report).</div>""", unsafe_allow_html=True)
+        label_column = st.selectbox("🏷️ Colonna che identifica la riga (es. regione, provincia):",
+                                    list(df.columns), key=f"row_reports_label_{sheet_key}")
+        instructions = st.text_area("✍️ Descrizione dei dati e istruzioni per il report:",
+                                    placeholder="Es. I dati riportano la popolazione residente per regione nel 2023 (fonte ISTAT). "
+                                                "Scrivi un report di 500 caratteri con tono divulgativo.",
+                                    key=f"row_reports_instructions_{sheet_key}")
+        if st.button("🚀 Genera report", disabled=not instructions.strip(), key=f"row_reports_button_{sheet_key}"):
+            progress = st.progress(0.0, text="Generazione dei report in corso...")
+            reports = generate_row_reports(
+                df=df,
+                instructions=instructions,
+                label_column=label_column,
+                model=st.session_state.get("selected_model", "gpt-4.1-nano"),
+                temperature=st.session_state.get("temperature", 0.7),
+                top_p=st.session_state.get("top_p", 1.0),
+                progress_callback=lambda done, total: progress.progress(done / total, text=f"Report generati: {done}/{total}"),
+                owner=st.session_state.session_id
+            )
+            st.session_state.row_reports = (sheet_key, reports)
+            progress.empty()
+
+        # Report generati per un foglio diverso da quello caricato ora: vengono scartati
+        stored_key, reports = st.session_state.get("row_reports") or (None, None)
+        if stored_key != sheet_key:
+            st.session_state.pop("row_reports", None)
+        elif reports is not None:
+            st.dataframe(reports, hide_index=True)
+            st.download_button(
+                label="📥 Download report [CSV]",
+                data=reports.to_csv(index=False).encode("utf-8-sig"),
+                file_name="report_per_riga.csv",
+                mime="text/csv",
+                key=f"row_reports_download_{sheet_key}"
+            )
+
 
 def render_download_conversation(tab_key, chat_history, conversation_started):
     with st.expander("💾 Download conversazione", expanded=False):
@@ -252,15 +446,26 @@ def render_download_conversation(tab_key, chat_history, conversation_started):
             disabled=disabilita
         )
         formato = formati[formato_label]
-        
-        export_result = export_chat(formato.lower(), chat_history) if not disabilita else None
-        
+
+        table_sheets = formato == "XLSX" and st.checkbox("Una tabella per foglio", key=f"export_table_sheets_{tab_key}", disabled=disabilita)
+
+        # Il file viene generato solo su richiesta e conservato finché la conversazione e il formato non cambiano
+        export_key = f"export_result_{tab_key}"
+        signature = (formato, table_sheets, conversation_signature(chat_history)) if not disabilita else None
+        prepared = st.session_state.get(export_key)
+        if prepared is not None and prepared[0] != signature:
+            prepared = None
+        if prepared is None and st.button(f"⚙️ Prepara file [{formato}]", disabled=disabilita, key=f"prepare_button_{tab_key}"):
+            with st.spinner("Preparazione del file..."):
+                prepared = st.session_state[export_key] = (signature, export_chat(formato.lower(), chat_history, table_sheets))
+        export_result = prepared[1] if prepared is not None else None
+
         st.download_button(
             label=f"📥 Download conversazione [{formato}]",
             data=export_result[0] if export_result else b"",
             file_name=export_result[2] if export_result else "",
             mime=export_result[1] if export_result else "",
-            disabled=disabilita,
+            disabled=disabilita or export_result is None,
             key=download_key
         )
 
@@ -302,6 +507,13 @@ def render_conversation_options(tab_key, conversation_started):
     )
         )
         st.session_state["selected_model"] = modelli[modello_label]
+
+        st.session_state["streaming"] = st.checkbox(
+            "⚡ Mostra la risposta mentre viene scritta (streaming)",
+            value=True,
+            key=f"streaming_{tab_key}",
+            help="Il testo compare man mano che il modello lo genera, invece che tutto insieme alla fine."
+        )
         
         # Controlli creatività e distribuzione
         st.session_state["temperature"] = st.slider(
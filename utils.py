@@ -3,15 +3,32 @@ import time
 import pandas as pd
 import numpy as np
 import io
+import copy
 from docx import Document
-import markdown2
-from html2docx import html2docx
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
 import re
 from typing import Any
 import traceback
+import logging
+import ast
+import hashlib
+
+from cache import LRUCache
+from code_result import CodeResult
+from markdown_blocks import parse_blocks, parse_inline, heading_level, list_item, typed_cell
+
+logger = logging.getLogger(__name__)
 
 
 def reset_conversation():
+    # Annullo le richieste al modello ancora in corso per questa sessione (risposte in streaming, report per riga).
+    # Import locale: utils viene importato anche dai processi della sandbox, che non usano il client OpenAI
+    from api import cancel_requests
+    if "session_id" in st.session_state:
+        cancel_requests(st.session_state.session_id)
+
     # Nuovo ID sessione per forzare ricaricamento
     st.session_state.session_id = str(time.time())
     
@@ -19,7 +36,8 @@ def reset_conversation():
     keys_to_reset = ["chat_history1", "chat_history2", "chat_history3"
                      , "file_loaded1", "uploaded_file1"
                      , "file_loaded2", "uploaded_file2"
-                     , "dataframe", "dataframe_report", "data_metadata", "data_errors"]
+                     , "dataframe", "dataframe_report", "data_metadata", "data_errors", "row_reports", "data_source1"
+                     , "export_result_file_tab", "export_result_report_tab", "export_result_chat_tab"]
     for key in keys_to_reset:
         if key in st.session_state:
             del st.session_state[key]
@@ -59,179 +77,240 @@ def init_session_state():
     if "session_id" not in st.session_state:
         st.session_state.session_id = str(time.time())
 
-def export_chat(format_type, chat_history):
-    if chat_history == []:
-        st.warning("Non ci sono messaggi da esportare.")
-        return None
+# Frammenti di esportazione già convertiti per messaggio, indicizzati per (formato, ruolo, hash del contenuto):
+# aggiungere un messaggio alla conversazione converte solo quel messaggio
+_export_fragments = LRUCache(max_entries=4096)
 
-    if format_type == "xlsx":
-        conv_rows = []   # Lista di dict: ogni dict rappresenta una riga in Conversazione
 
-        for msg in chat_history:
-            role = "Utente" if msg["role"] == "user" else "Assistente"
-            content = msg["content"] or ""
-            lines = content.splitlines()
+def _message_hash(msg) -> str:
+    return hashlib.blake2b((msg.get("content") or "").encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
 
-            # Se il messaggio è vuoto, lo tratto come riga unica di testo vuoto
-            if not lines:
-                conv_rows.append({"Ruolo": role, "Messaggio": ""})
-                continue
 
-            i = 0
-            # Scorro tutte le righe di questo messaggio
-            while i < len(lines):
-                # Caso 1: incontro un possibile blocco-tabella Markdown
-                # Deve esserci almeno una riga per header e una riga per separatore
-                if (
-                    i + 1 < len(lines)
-                    and re.match(r"^\|(.+\|)+\s*$", lines[i])
-                    and re.match(r"^\|\s*[-:]+\s*(\|\s*[-:]+\s*)+\|\s*$", lines[i+1])
-                ):
-                    # Trovo la tabella a partire da lines[i]
-                    headers = [h.strip() for h in lines[i].strip("|").split("|")]
-
-                    # Raccolgo tutte le righe dati fino a che iniziano con ‘|’
-                    data_rows = []
-                    j = i + 2
-                    while j < len(lines) and lines[j].strip().startswith("|"):
-                        data_rows.append([c.strip() for c in lines[j].strip("|").split("|")])
-                        j += 1
-
-                    # 1) Se prima della tabella c’erano righe di testo “normale”, le inserisco in una riga separata
-                    #    (solo se i > partenza di questo segmento)
-                    #    Qui però, siccome stiamo entrando solo quando troviamo la tabella, 
-                    #    eventuali righe di testo provenienti da cicli precedenti sono già state gestite.
-
-                    # 2) Inserisco la riga “header” della tabella nel foglio Excel:
-                    row_header = {"Ruolo": role}
-                    for idx, hdr in enumerate(headers, start=1):
-                        row_header[f"Col{idx}"] = hdr
-                    conv_rows.append(row_header)
-
-                    # 3) Inserisco le righe dati, con colonna “Ruolo” vuota
-                    for data in data_rows:
-                        row_data = {"Ruolo": ""}
-                        for idx, val in enumerate(data, start=1):
-                            row_data[f"Col{idx}"] = val
-                        conv_rows.append(row_data)
-
-                    # 4) Salto tutto il blocco tabella
-                    i = j
+def conversation_signature(chat_history) -> str:
+    """Impronta della conversazione: cambia se un messaggio viene aggiunto, rimosso o modificato"""
+    digest = hashlib.blake2b(digest_size=16)
+    for msg in chat_history:
+        digest.update(f"{msg['role']}:{_message_hash(msg)};".encode())
+    return digest.hexdigest()
+
+
+def _cached_fragment(format_type, msg, convert):
+    return _export_fragments.get_or_compute((format_type, msg["role"], _message_hash(msg)), convert)
+
+
+_XLSX_HEADER_FONT = Font(bold=True)
+
+
+def _message_blocks(msg):
+    """Blocchi markdown del messaggio (analizzati una volta sola e condivisi da tutti i formati)"""
+    return _cached_fragment("blocks", msg, lambda: parse_blocks(msg.get("content") or ""))
+
+
+def _xlsx_header_row(sheet, values):
+    """Riga di intestazione in grassetto (come quella scritta da pandas)"""
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.font = _XLSX_HEADER_FONT
+        cells.append(cell)
+    sheet.append(cells)
+
+
+def _xlsx_value(value):
+    """Valore di una cella dei risultati dei calcoli nel formato accettato da openpyxl (mancanti come celle vuote)"""
+    if isinstance(value, np.float32):
+        value = float(str(value))  # Valore nella precisione originale (0.1 e non 0.10000000149011612)
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp) and value.tzinfo is not None:
+        return value.tz_localize(None)  # Excel non gestisce i fusi orari
+    if isinstance(value, (str, int, float, bool, pd.Timestamp)):
+        return value
+    return str(value)
 
-                else:
-                    # Caso 2: questa riga NON fa parte di una tabella markdown.
-                    # Resto in “modalità testo normale” finché non trovo l’inizio di una tabella
-                    testo_accumulato = []
-                    while i < len(lines):
-                        # Se la riga corrente è inizio di tabella, interrompo il “testo normale”
-                        if (
-                            i + 1 < len(lines)
-                            and re.match(r"^\|(.+\|)+\s*$", lines[i])
-                            and re.match(r"^\|\s*[-:]+\s*(\|\s*[-:]+\s*)+\|\s*$", lines[i+1])
-                        ):
-                            break
-                        # Altrimenti accumulo questa riga in testo_accumulato
-                        testo_accumulato.append(lines[i])
-                        i += 1
-
-                    # Inserisco tutto il blocco “testo normale” in un’unica riga nel DataFrame
-                    testo_unico = "\n".join(testo_accumulato).strip()
-                    conv_rows.append({
-                        "Ruolo": role,
-                        "Messaggio": testo_unico
-                    })
-                    # Torno nel loop principale (che controllerà di nuovo se ora ci sono tabelle)
-            # Fine while i < len(lines)
-
-        # A questo punto conv_rows contiene sia:
-        # - righe con chiavi “Ruolo” + “Messaggio” (messaggi normali)
-        # - righe con chiavi “Ruolo” vuoto o “Ruolo” + Col1, Col2, ... (per le tabelle)
-
-        # Costruisco il DataFrame rettangolare, unificando tutte le colonne possibili
-        df_conv = pd.DataFrame(conv_rows).fillna("")
-
-        # Compongo l’ordine definitivo delle colonne:
-        #   1) “Ruolo”
-        #   2) “Messaggio” (se presente)
-        #   3) tutte le “Col1”, “Col2”, ... in ordine numerico
-        tutte_colonne = ["Ruolo"]
-        if "Messaggio" in df_conv.columns:
-            tutte_colonne.append("Messaggio")
-
-        col_tabella = sorted(
-            [c for c in df_conv.columns if c.startswith("Col")],
-            key=lambda x: int(x.replace("Col", ""))
-        )
-        tutte_colonne.extend(col_tabella)
 
-        # Ricreo il DataFrame con solo queste colonne, riempiendo eventuali buchi con stringhe vuote
-        df_final = df_conv.reindex(columns=tutte_colonne).fillna("")
+def _write_xlsx(messages, table_sheets=False):
+    """
+    Scrive la conversazione in un file Excel in modalità write-only: le righe vengono emesse direttamente
+    nel foglio mentre si scorrono i blocchi dei messaggi, senza costruire DataFrame intermedi, così che la memoria
+    resti costante anche con tabelle di migliaia di righe. Le celle numeriche delle tabelle sono scritte come numeri.
+    messages contiene (ruolo, blocchi, tabelle complete dei risultati dei calcoli), queste ultime scritte dopo il messaggio.
+    Con table_sheets ogni tabella viene scritta in un foglio proprio ("Tabella N"), richiamato nel foglio Conversazione.
+    """
+    # Prima passata sui blocchi (già analizzati): colonne necessarie al foglio “Conversazione”
+    has_text = any(not blocks or result_tables or any(block.kind != "table" or table_sheets for block in blocks)
+                   for _, blocks, result_tables in messages)
+    table_columns = 0 if table_sheets else max(
+        [len(row) for _, blocks, _ in messages for block in blocks if block.kind == "table" for row in (block.header,) + block.rows]
+        + [table.shape[1] for _, _, result_tables in messages for table in result_tables],
+        default=0)
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Conversazione")
+    # Colonne: “Ruolo”, “Messaggio” (se presente), “Col1”, “Col2”, ...
+    _xlsx_header_row(sheet, ["Ruolo"] + (["Messaggio"] if has_text else []) + [f"Col{idx}" for idx in range(1, table_columns + 1)])
+    padding = [None] if has_text else []
+    tables = 0
+
+    def write_table(role, header, rows):
+        nonlocal tables
+        if table_sheets:
+            tables += 1
+            table_sheet = workbook.create_sheet(f"Tabella {tables}")
+            _xlsx_header_row(table_sheet, header)
+            for row in rows:
+                table_sheet.append(row)
+            table_sheet.close()  # Il foglio completato viene scritto su file e chiuso subito
+            sheet.append([role, f"[Tabella nel foglio “Tabella {tables}”]"])
+        else:
+            # Riga “header” della tabella, poi le righe dati con colonna “Ruolo” vuota
+            sheet.append([role] + padding + header)
+            for row in rows:
+                sheet.append([None] + padding + row)
+
+    for role, blocks, result_tables in messages:
+        # Se il messaggio è vuoto, lo tratto come riga unica di testo vuoto
+        if not blocks:
+            sheet.append([role, ""])
+
+        testo_accumulato = []
+        for block in blocks:
+            if block.kind != "table":
+                # Testo, codice e formule restano nel testo del messaggio, come scritti dal modello
+                testo_accumulato.append(block.source)
+                continue
 
-        # Scrittura su Excel in un unico foglio “Conversazione”
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df_final.to_excel(writer, index=False, sheet_name="Conversazione")
+            # Il testo che precede la tabella va in un'unica riga
+            if testo_accumulato:
+                sheet.append([role, "\n".join(testo_accumulato).strip()])
+                testo_accumulato = []
+            write_table(role, list(block.header), ([typed_cell(value) for value in data] for data in block.rows))
+
+        if testo_accumulato:
+            sheet.append([role, "\n".join(testo_accumulato).strip()])
+
+        # Tabelle complete dei calcoli: valori già tipizzati, letti direttamente dal DataFrame
+        for table in result_tables:
+            sheet.append([role, f"Risultato completo del calcolo ({len(table)} righe)"])
+            write_table(role, [str(column) for column in table.columns]
+                        , ([_xlsx_value(value) for value in row]
+                           for row in zip(*(table.iloc[:, position].array for position in range(table.shape[1])))))
+
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def _add_inline_runs(paragraph, text):
+    for style, segment in parse_inline(text):
+        run = paragraph.add_run(segment)
+        if style == "bold":
+            run.bold = True
+        elif style == "italic":
+            run.italic = True
+        elif style == "code":
+            run.font.name = "Courier New"
+
+
+def _render_docx_text(doc, source):
+    """Paragrafi, titoli ed elenchi di un blocco di testo markdown"""
+    paragraph = None
+    for line in source.splitlines():
+        if not line.strip():
+            paragraph = None
+            continue
+        level, title = heading_level(line)
+        if level:
+            doc.add_heading(title, level=level)
+            paragraph = None
+            continue
+        kind, item = list_item(line)
+        if kind:
+            _add_inline_runs(doc.add_paragraph(style="List Bullet" if kind == "bullet" else "List Number"), item)
+            paragraph = None
+            continue
+        # Le righe consecutive formano un unico paragrafo, come nel rendering markdown
+        if paragraph is None:
+            paragraph = doc.add_paragraph()
+        else:
+            paragraph.add_run(" ")
+        _add_inline_runs(paragraph, line.strip())
+
+
+def _render_docx_table(doc, block):
+    columns = max([len(block.header)] + [len(row) for row in block.rows])
+    table = doc.add_table(rows=1 + len(block.rows), cols=columns)
+    table.style = "Table Grid"
+    for r, (row, values) in enumerate(zip(table.rows, (block.header,) + block.rows)):
+        for cell, value in zip(row.cells, values):
+            cell.text = value
+            if r == 0 and cell.paragraphs[0].runs:
+                cell.paragraphs[0].runs[0].bold = True
+
+
+def _render_docx_message(doc, role, blocks):
+    """Aggiunge al documento il messaggio: intestazione con il ruolo, poi i blocchi convertiti direttamente in DOCX"""
+    doc.add_paragraph().add_run(f"{role}:").bold = True
+    for block in blocks:
+        if block.kind == "table":
+            _render_docx_table(doc, block)
+        elif block.kind == "code":
+            code = "\n".join(block.source.splitlines()[1:-1])
+            doc.add_paragraph().add_run(code).font.name = "Courier New"
+        elif block.kind == "latex":
+            doc.add_paragraph(block.source.strip())
+        else:
+            _render_docx_text(doc, block.source)
+
+
+def export_chat(format_type, chat_history, table_sheets=False):
+    """
+    Esporta la conversazione in xlsx, txt o docx; restituisce (contenuto, mime type, nome file).
+    Con table_sheets l'esportazione xlsx scrive ogni tabella in un foglio separato.
+    Ogni messaggio viene suddiviso una sola volta in blocchi (parse_blocks) condivisi dai formati, e la sua
+    conversione viene memorizzata (_export_fragments), così che esportare di nuovo
+    una conversazione più lunga converta solo i messaggi nuovi.
+    """
+    if chat_history == []:
+        st.warning("Non ci sono messaggi da esportare.")
+        return None
 
+    if format_type == "xlsx":
+        messages = [("Utente" if msg["role"] == "user" else "Assistente", _message_blocks(msg), msg.get("result_tables", []))
+                    for msg in chat_history]
         return (
-            output.getvalue(),
+            _write_xlsx(messages, table_sheets),
             "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             "conversazione.xlsx"
         )
 
     elif format_type == "txt":
-        content = ""
-        for msg in chat_history:
-            prefix = "Utente: " if msg["role"] == "user" else "Assistente: "
-            content += f"{prefix}{msg['content']}\n\n"
+        content = "".join(
+            f"{'Utente: ' if msg['role'] == 'user' else 'Assistente: '}{msg['content']}\n\n" for msg in chat_history
+        )
         return content.encode(), "text/plain", "conversazione.txt"
 
     elif format_type == "docx":
         try:
             final_doc = Document()
+            body = final_doc.element.body
 
-            for idx, msg in enumerate(chat_history, start=1):
-                text = msg.get("content", "").strip()
-                if not text:
+            for msg in chat_history:
+                if not (msg.get("content") or "").strip():
                     continue
-
-                role = "Utente" if msg["role"] == "user" else "Assistente"
-                markdown_text = f"**{role}:**\n\n{text}"
-
-                # Provo a convertire tutto in HTML (inclusi i blocchi tabella)
-                html = markdown2.markdown(markdown_text, extras=["tables", "fenced-code-blocks"])
-                try:
-                    temp_stream = html2docx(html, title=f"msg_{idx}")
-                    from docx import Document as _Doc
-                    temp_doc = _Doc(io.BytesIO(temp_stream.getvalue()))
-                    for element in temp_doc.element.body:
-                        final_doc.element.body.append(element)
-                except Exception:
-                    # Fallback manual per tabelle Markdown
-                    lines = markdown_text.splitlines()
-                    if (len(lines) >= 3
-                        and re.match(r"^\|.+\|$", lines[0])
-                        and re.match(r"^\|\s*[-:]+\s*(\|\s*[-:]+\s*)+\|$", lines[1])):
-
-                        headers = [h.strip() for h in lines[0].strip("|").split("|")]
-                        data_rows = []
-                        for row in lines[2:]:
-                            if not row.strip().startswith("|"):
-                                break
-                            data_rows.append([c.strip() for c in row.strip("|").split("|")])
-
-                        table = final_doc.add_table(rows=1 + len(data_rows), cols=len(headers))
-
-
-                        for i, hdr in enumerate(headers):
-                            table.rows[0].cells[i].text = hdr
-                        for r, row in enumerate(data_rows, start=1):
-                            for c, val in enumerate(row):
-                                table.rows[r].cells[c].text = val
-                        final_doc.add_paragraph("")  # spazio dopo la tabella
-                    else:
-                        p = final_doc.add_paragraph()
-                        p.add_run(markdown_text)
-
+                key = ("docx", msg["role"], _message_hash(msg))
+                elements = _export_fragments.get(key)
+                if elements is None:
+                    # Converto il messaggio direttamente nel documento e ne memorizzo una copia degli elementi
+                    first = len(body) - 1  # Il corpo termina sempre con le proprietà di sezione (sectPr)
+                    _render_docx_message(final_doc, "Utente" if msg["role"] == "user" else "Assistente", _message_blocks(msg))
+                    _export_fragments.put(key, [copy.deepcopy(element) for element in body[first:len(body) - 1]])
+                else:
+                    # Copio gli elementi memorizzati: inserirli nel documento li sposterebbe dalla cache
+                    for element in elements:
+                        body.insert_element_before(copy.deepcopy(element), "w:sectPr")
                 final_doc.add_paragraph("")  # spazio tra i messaggi
 
             output = io.BytesIO()
@@ -243,31 +322,296 @@ def export_chat(format_type, chat_history):
             )
         except ImportError:
             st.error(
-                "Per esportare in DOCX con Markdown servono: "
-                "python-docx, markdown2, html2docx"
+                "Per esportare in DOCX serve il pacchetto python-docx"
             )
             return None
 
 
-# formatta l'output come tabella Markdown
-def _format_list_of_dicts_as_markdown(data):
-    if not data or not isinstance(data, list):
-        return data
-    if not all(isinstance(row, dict) for row in data):
-        return data
+# Resolver delle colonne, condivisi per schema tra chiamate e DataFrame derivati
+_column_resolvers = LRUCache(max_entries=64)
+
+
+def _normalize_column_name(name: str) -> str:
+    return name.lower().replace(' ', '').replace('_', '').replace('-', '')
+
 
-    keys = list({key for row in data for key in row})
-    if not keys:
-        return data
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
 
-    header = "| " + " | ".join(keys) + " |"
-    separator = "| " + " | ".join(["---"] * len(keys)) + " |"
-    rows = []
-    for row in data:
-        line = "| " + " | ".join(str(row.get(k, "")) for k in keys) + " |"
-        rows.append(line)
 
-    return "\n".join([header, separator] + rows)
+class ColumnResolver:
+    """
+    Risolve i nomi di colonna usati dal modello (ignorando case, con varianti plurali/singolari e fuzzy matching).
+    Gli indici sono precalcolati una volta per schema e ogni chiave viene risolta una sola volta:
+    1. match esatto case-insensitive (incluse le varianti plurali/singolari)
+    2. match sul nome normalizzato (senza spazi, underscore e trattini)
+    3. match parziale (una stringa contenuta nell'altra), sulla prima colonna in ordine
+    4. match fuzzy se almeno il 50% delle parole della chiave compare nel nome della colonna
+    5. altrimenti la chiave originale
+    """
+
+    _MAX_MEMO = 4096
+    _MAX_SUBSTRING_KEY = 128
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self._exact = {}
+        self._normalized = {}
+        self._normalized_names = []
+        self._positions = {}       # nome normalizzato -> posizioni delle colonne
+        self._trigram_index = {}   # trigramma -> posizioni delle colonne (nome normalizzato)
+        self._word_index = {}      # parola -> posizioni delle colonne
+        self._memo = {}
+
+        for position, col in enumerate(self.columns):
+            col_lower = str(col).lower()
+            self._exact[col_lower] = col
+            # Aggiungi anche versioni plurali/singolari comuni
+            if col_lower.endswith('e'):
+                self._exact[col_lower[:-1] + 'i'] = col  # regione -> regioni
+            elif col_lower.endswith('a'):
+                self._exact[col_lower[:-1] + 'e'] = col  # persona -> persone
+            elif col_lower.endswith('o'):
+                self._exact[col_lower[:-1] + 'i'] = col  # prodotto -> prodotti
+            elif col_lower.endswith('i'):
+                self._exact[col_lower[:-1] + 'e'] = col  # regioni -> regione
+                self._exact[col_lower[:-1] + 'o'] = col  # prodotti -> prodotto
+
+            col_normalized = _normalize_column_name(col_lower)
+            self._normalized.setdefault(col_normalized, col)
+            self._normalized_names.append(col_normalized)
+            self._positions.setdefault(col_normalized, []).append(position)
+            for trigram in _trigrams(col_normalized):
+                self._trigram_index.setdefault(trigram, []).append(position)
+            for word in set(col_lower.split()):
+                self._word_index.setdefault(word, []).append(position)
+
+    def resolve(self, key: str) -> Any:
+        """Restituisce la colonna corrispondente a key (o key stessa se non trova corrispondenze)"""
+        if key in self._memo:
+            return self._memo[key]
+        found, match_type = self._match(key)
+        if found is None:
+            found = key
+            logger.debug("Column match: %r -> no match found, available columns: %s", key, self.columns,
+                         extra={"column_key": key, "column_match": "none"})
+        else:
+            logger.debug("Column match: %r -> %r (%s)", key, found, match_type,
+                         extra={"column_key": key, "column": found, "column_match": match_type})
+        if len(self._memo) >= self._MAX_MEMO:
+            self._memo.clear()
+        self._memo[key] = found
+        return found
+
+    def _match(self, key: str):
+        key_lower = key.lower()
+        if key_lower in self._exact:
+            return self._exact[key_lower], "exact case-insensitive"
+
+        key_normalized = _normalize_column_name(key_lower)
+        if key_normalized in self._normalized:
+            return self._normalized[key_normalized], "normalized"
+
+        position = self._partial_match(key_normalized)
+        if position is not None:
+            return self.columns[position], "partial match"
+
+        position = self._word_match(key_lower)
+        if position is not None:
+            return self.columns[position], "fuzzy word match"
+        return None, None
+
+    def _partial_match(self, key_normalized: str) -> Any:
+        """Prima colonna il cui nome normalizzato contiene la chiave o vi è contenuto (i match sul nome
+        minuscolo sono sempre anche match sul nome normalizzato)"""
+        key_trigrams = _trigrams(key_normalized)
+        if key_trigrams:
+            # Colonne che contengono la chiave: devono avere tutti i suoi trigrammi
+            postings = sorted((self._trigram_index.get(t, []) for t in key_trigrams), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = set(range(len(self.columns)))
+        # Colonne contenute nella chiave: il loro nome normalizzato è una sottostringa della chiave
+        length = len(key_normalized)
+        if length > self._MAX_SUBSTRING_KEY:
+            candidates = range(len(self.columns))
+            length = -1
+        for start in range(length + 1):
+            for end in range(start, length + 1):
+                candidates.update(self._positions.get(key_normalized[start:end], ()))
+
+        for position in sorted(candidates):
+            col_normalized = self._normalized_names[position]
+            if key_normalized in col_normalized or col_normalized in key_normalized:
+                return position
+        return None
+
+    def _word_match(self, key_lower: str) -> Any:
+        """Prima colonna che condivide almeno il 50% delle parole della chiave"""
+        key_words = set(key_lower.split())
+        if not key_words:
+            return 0 if self.columns else None
+        hits = {}
+        for word in key_words:
+            for position in self._word_index.get(word, ()):
+                hits[position] = hits.get(position, 0) + 1
+        matches = [p for p, count in hits.items() if count >= len(key_words) * 0.5]
+        return min(matches) if matches else None
+
+
+class CIDataFrame(pd.DataFrame):
+    """
+    Vista case-insensitive (con accesso fuzzy alle colonne) sul DataFrame dell'utente.
+    La costruzione da un DataFrame non copia i dati e non esegue elaborazioni: il resolver delle colonne viene costruito
+    alla prima ricerca e condivisa, tramite cache per schema, da tutti i DataFrame derivati con le stesse colonne.
+    """
+
+    @property
+    def _resolver(self) -> ColumnResolver:
+        columns = self.columns
+        cached = self.__dict__.get("_resolver_cache")
+        if cached is None or cached[0] is not columns:
+            resolver = _column_resolvers.get_or_compute(tuple(columns), lambda: ColumnResolver(columns))
+            cached = (columns, resolver)
+            object.__setattr__(self, "_resolver_cache", cached)
+        return cached[1]
+
+    @property
+    def _constructor(self):
+        return CIDataFrame
+
+    def _find_column(self, key):
+        """Trova la colonna corrispondente ignorando case e con fuzzy matching"""
+        if not isinstance(key, str):
+            return key
+        return self._resolver.resolve(key)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            matched_key = self._find_column(key)
+            return super().__getitem__(matched_key)
+        elif isinstance(key, list):
+            # Gestisci liste di colonne
+            matched_keys = [self._find_column(k) if isinstance(k, str) else k for k in key]
+            return super().__getitem__(matched_keys)
+        return super().__getitem__(key)
+
+    def __getattr__(self, name):
+        # Gestisce l'accesso df.colonna
+        if name.startswith('_') or name in ['columns', 'index', 'values']:
+            return super().__getattribute__(name)
+
+        try:
+            matched_name = self._find_column(name)
+            if matched_name in self.columns:
+                return self[matched_name]
+            return super().__getattribute__(name)
+        except AttributeError:
+            # Se non è una colonna, prova l'attributo normale
+            return super().__getattribute__(name)
+
+    def groupby(self, by, **kwargs):
+        # Gestisce groupby con nomi case-insensitive; con colonne category mostra solo i gruppi presenti nei dati
+        kwargs.setdefault("observed", True)
+        if isinstance(by, str):
+            by = self._find_column(by)
+        elif isinstance(by, list):
+            by = [self._find_column(col) if isinstance(col, str) else col for col in by]
+        return super().groupby(by, **kwargs)
+
+    def sort_values(self, by, **kwargs):
+        # Gestisce sort_values con nomi case-insensitive
+        if isinstance(by, str):
+            by = self._find_column(by)
+        elif isinstance(by, list):
+            by = [self._find_column(col) if isinstance(col, str) else col for col in by]
+        return super().sort_values(by, **kwargs)
+
+    def drop(self, labels, **kwargs):
+        # Gestisce drop con nomi case-insensitive
+        if isinstance(labels, str):
+            labels = self._find_column(labels)
+        elif isinstance(labels, list):
+            labels = [self._find_column(col) if isinstance(col, str) else col for col in labels]
+        return super().drop(labels, **kwargs)
+
+
+
+# Codice compilato degli snippet generati dal modello, indicizzato per hash del sorgente
+_compiled_snippets = LRUCache(max_entries=256)
+# Variabile nascosta che riceve il valore dell'ultima espressione dello snippet
+_LAST_EXPRESSION = "__last_expression__"
+_ALLOWED_IMPORTS = {("numpy", "np"), ("pandas", "pd")}
+# Attributi che rendono il risultato non riproducibile (np.random, df.sample, pd.Timestamp.now, ...)
+_NON_DETERMINISTIC_ATTRIBUTES = {"random", "sample", "now", "today"}
+
+
+class _AllowedImportRemover(ast.NodeTransformer):
+    """Sostituisce gli import permessi (np e pd sono già disponibili) con istruzioni vuote"""
+
+    def visit_Import(self, node):
+        return ast.copy_location(ast.Pass(), node)
+
+
+def _strip_markdown(code: str) -> str:
+    """Rimuove la formattazione markdown (**testo**, *testo*) finita per errore nel codice"""
+    code = re.sub(r'\*\*(.*?)\*\*', r'\1', code)
+    return re.sub(r'(?<!\*)\*(.*?)\*(?!\*)', r'\1', code)
+
+
+def _compile_snippet(code: str) -> tuple:
+    # Rimuovi ```python e ``` all'inizio e fine
+    source = re.sub(r'^```(?:python)?\s*\n', '', code, flags=re.MULTILINE)
+    source = re.sub(r'\n```\s*$', '', source, flags=re.MULTILINE)
+    try:
+        tree = ast.parse(source, "<string>")
+    except SyntaxError:
+        # Solo se il codice non è valido provo a togliere il markdown (che altererebbe ad es. gli operatori * e **)
+        source = _strip_markdown(source)
+        tree = ast.parse(source, "<string>")
+
+    # Import permessi solo per numpy e pandas
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) or (
+                isinstance(node, ast.Import) and any((alias.name, alias.asname) not in _ALLOWED_IMPORTS for alias in node.names)):
+            statement = ast.get_source_segment(source, node) or ast.unparse(node)
+            return source, None, None, f"Import vietato: '{statement}'. Solo 'import numpy as np' o 'import pandas as pd' sono ammessi.", None
+    tree = _AllowedImportRemover().visit(tree)
+
+    # L'ultima espressione diventa un'assegnazione alla variabile nascosta; di un'assegnazione finale si ricorda il nome
+    last_assigned = None
+    if tree.body:
+        last = tree.body[-1]
+        if isinstance(last, ast.Expr):
+            tree.body[-1] = ast.copy_location(
+                ast.Assign(targets=[ast.Name(id=_LAST_EXPRESSION, ctx=ast.Store())], value=last.value), last)
+        elif isinstance(last, ast.Assign) and len(last.targets) == 1 and isinstance(last.targets[0], ast.Name):
+            last_assigned = last.targets[0].id
+    ast.fix_missing_locations(tree)
+
+    # Chiave normalizzata del calcolo (indipendente da spazi e commenti), solo per codice deterministico
+    deterministic = not any(isinstance(node, ast.Attribute) and node.attr in _NON_DETERMINISTIC_ATTRIBUTES
+                            for node in ast.walk(tree))
+    result_key = hashlib.blake2b(ast.dump(tree).encode(), digest_size=16).hexdigest() if deterministic else None
+    return source, compile(tree, "<string>", "exec"), last_assigned, None, result_key
+
+
+def _prepare_code(code: str) -> tuple:
+    """
+    Pulisce, valida e compila lo snippet in un'unica analisi AST, con cache per hash del sorgente.
+    Restituisce (sorgente pulito, codice compilato, nome dell'ultima variabile assegnata, errore di import,
+    chiave normalizzata del calcolo o None se il risultato non è riutilizzabile).
+    """
+    key = hashlib.blake2b(code.encode(), digest_size=16).hexdigest()
+    return _compiled_snippets.get_or_compute(key, lambda: _compile_snippet(code))
+
+
+def code_cache_key(code: str) -> Any:
+    """Chiave del risultato di uno snippet (uguale per codice con lo stesso AST), None se non memorizzabile"""
+    try:
+        return _prepare_code(code)[4]
+    except SyntaxError:
+        return None
 
 
 # Funzione sandboxed per eseguire codice su df
@@ -275,135 +619,11 @@ def execute_code(code: str, df: pd.DataFrame) -> Any:
     """
     Esegue in sandbox un blocco di codice Python che utilizza la variabile `df`.
     Si attende che venga definita in esso una variabile `result`.
-    Restituisce sempre JSON serializzabile senza includere indici.
+    Restituisce un CodeResult (tabella o valore) oppure un dict con la chiave "error".
     L'accesso alle colonne è case-insensitive e supporta anche accesso fuzzy.
     """
     
-    class CIDataFrame(pd.DataFrame):
-        def __init__(self, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            # Crea mappatura case-insensitive e fuzzy delle colonne
-            #self._col_map = {}
-            object.__setattr__(self, "_col_map", {})
-            for col in self.columns:
-                col_lower = str(col).lower()
-                self._col_map[col_lower] = col
-                # Aggiungi anche versioni plurali/singolari comuni
-                if col_lower.endswith('e'):
-                    self._col_map[col_lower[:-1] + 'i'] = col  # regione -> regioni
-                elif col_lower.endswith('a'):
-                    self._col_map[col_lower[:-1] + 'e'] = col  # persona -> persone
-                elif col_lower.endswith('o'):
-                    self._col_map[col_lower[:-1] + 'i'] = col  # prodotto -> prodotti
-                elif col_lower.endswith('i'):
-                    self._col_map[col_lower[:-1] + 'e'] = col  # regioni -> regione
-                    self._col_map[col_lower[:-1] + 'o'] = col  # prodotti -> prodotto
-                elif col_lower.endswith('e') and len(col_lower) > 3:
-                    self._col_map[col_lower[:-1] + 'a'] = col  # persone -> persona
-
-        @property
-        def _constructor(self):
-            return CIDataFrame
-        
-        def _find_column(self, key):
-            """Trova la colonna corrispondente ignorando case e con fuzzy matching"""
-            if not isinstance(key, str):
-                return key
-            
-            key_lower = key.lower()
-            original_key = key  # Salva per debugging
-            
-            # 1. Cerca match esatto case-insensitive
-            if key_lower in self._col_map:
-                found = self._col_map[key_lower]
-                print(f"Column match: '{original_key}' -> '{found}' (exact case-insensitive)")
-                return found
-            
-            # 2. Normalizza la chiave (rimuovi spazi, underscore, etc.)
-            key_normalized = key_lower.replace(' ', '').replace('_', '').replace('-', '')
-            
-            # 3. Cerca match con normalizzazione
-            for col in self.columns:
-                col_normalized = str(col).lower().replace(' ', '').replace('_', '').replace('-', '')
-                if key_normalized == col_normalized:
-                    print(f"Column match: '{original_key}' -> '{col}' (normalized)")
-                    return col
-            
-            # 4. Cerca match parziale (contiene) - con e senza normalizzazione
-            for col in self.columns:
-                col_lower = str(col).lower()
-                col_normalized = col_lower.replace(' ', '').replace('_', '').replace('-', '')
-                
-                # Match parziale normale
-                if (key_lower in col_lower or col_lower in key_lower or
-                    # Match parziale normalizzato
-                    key_normalized in col_normalized or col_normalized in key_normalized):
-                    print(f"Column match: '{original_key}' -> '{col}' (partial match)")
-                    return col
-            
-            # 5. Match fuzzy per parole chiave comuni
-            key_words = set(key_lower.split())
-            for col in self.columns:
-                col_words = set(str(col).lower().split())
-                # Se almeno il 50% delle parole corrispondono
-                if len(key_words & col_words) >= len(key_words) * 0.5:
-                    print(f"Column match: '{original_key}' -> '{col}' (fuzzy word match)")
-                    return col
-            
-            # 6. Se non trova niente, restituisce la chiave originale
-            print(f"Column match: '{original_key}' -> '{key}' (no match found, using original)")
-            print(f"Available columns: {list(self.columns)}")
-            return key
-
-        def __getitem__(self, key):
-            if isinstance(key, str):
-                matched_key = self._find_column(key)
-                return super().__getitem__(matched_key)
-            elif isinstance(key, list):
-                # Gestisci liste di colonne
-                matched_keys = [self._find_column(k) if isinstance(k, str) else k for k in key]
-                return super().__getitem__(matched_keys)
-            return super().__getitem__(key)
-        
-        def __getattr__(self, name):
-            # Gestisce l'accesso df.colonna
-            if name.startswith('_') or name in ['columns', 'index', 'values']:
-                return super().__getattribute__(name)
-            
-            try:
-                matched_name = self._find_column(name)
-                if matched_name in self.columns:
-                    return self[matched_name]
-                return super().__getattribute__(name)
-            except AttributeError:
-                # Se non è una colonna, prova l'attributo normale
-                return super().__getattribute__(name)
-        
-        def groupby(self, by, **kwargs):
-            # Gestisce groupby con nomi case-insensitive
-            if isinstance(by, str):
-                by = self._find_column(by)
-            elif isinstance(by, list):
-                by = [self._find_column(col) if isinstance(col, str) else col for col in by]
-            return super().groupby(by, **kwargs)
-        
-        def sort_values(self, by, **kwargs):
-            # Gestisce sort_values con nomi case-insensitive
-            if isinstance(by, str):
-                by = self._find_column(by)
-            elif isinstance(by, list):
-                by = [self._find_column(col) if isinstance(col, str) else col for col in by]
-            return super().sort_values(by, **kwargs)
-        
-        def drop(self, labels, **kwargs):
-            # Gestisce drop con nomi case-insensitive
-            if isinstance(labels, str):
-                labels = self._find_column(labels)
-            elif isinstance(labels, list):
-                labels = [self._find_column(col) if isinstance(col, str) else col for col in labels]
-            return super().drop(labels, **kwargs)
-
-    # Crea proxy CI
+    # Crea la vista case-insensitive (senza copia dei dati)
     df_ci = CIDataFrame(df)
     
     # Prepara builtins limitati
@@ -418,53 +638,11 @@ def execute_code(code: str, df: pd.DataFrame) -> Any:
     local_vars = {}
     
     try:
-        # Pulisci il codice da formattazione markdown
-        # Rimuovi ```python e ``` all'inizio e fine
-        code = re.sub(r'^```(?:python)?\s*\n', '', code, flags=re.MULTILINE)
-        code = re.sub(r'\n```\s*$', '', code, flags=re.MULTILINE)
-        
-        # Rimuovi asterischi attorno alle parole chiave Python
-        keywords = ['import', 'from', 'def', 'class', 'if', 'else', 'elif', 'for', 'while', 'try', 'except', 'finally', 'with', 'return', 'yield', 'lambda', 'and', 'or', 'not', 'in', 'is']
-        for keyword in keywords:
-            # Pattern per **keyword** -> keyword
-            code = re.sub(rf'\*\*{keyword}\*\*', keyword, code, flags=re.IGNORECASE)
-            # Pattern per *keyword* -> keyword  
-            code = re.sub(rf'(?<!\*)\*{keyword}\*(?!\*)', keyword, code, flags=re.IGNORECASE)
-        
-        # Rimuovi altri pattern markdown comuni
-        code = re.sub(r'\*\*(.*?)\*\*', r'\1', code)  # **testo** -> testo
-        code = re.sub(r'(?<!\*)\*(.*?)\*(?!\*)', r'\1', code)  # *testo* -> testo (ma non **)
-        
-        # Rimuovi commenti markdown che iniziano con molti #
-        lines = code.split('\n')
-        cleaned_lines = []
-        for line in lines:
-            # Se la riga inizia con più di 3 #, probabilmente è un titolo markdown
-            if re.match(r'^#{4,}', line.strip()):
-                continue
-            cleaned_lines.append(line)
-
-        # Intercetta import permessi (solo numpy e pandas)
-        import_lines = []
-        remaining_lines = []
-        for line in code.splitlines():
-            stripped = line.strip()
-            if re.match(r"^import\s+(numpy\s+as\s+np|pandas\s+as\s+pd)$", stripped):
-                # Import permesso → non lo includiamo nel codice, ma lo "simuliamo"
-                import_lines.append(stripped)
-            elif re.match(r"^\s*(import|from\s+\w+\s+import)", stripped):
-                return {
-                    "error": f"Import vietato: '{stripped}'. Solo 'import numpy as np' o 'import pandas as pd' sono ammessi.",
-                    "code": code
-                }
-            else:
-                remaining_lines.append(line)
-
-        # Sovrascrivi il codice senza le righe di import
-        code = '\n'.join(remaining_lines)
+        code, compiled, last_assigned, import_error, _ = _prepare_code(code)
+        if import_error:
+            return {"error": import_error, "code": code}
 
-        # Prova prima ad eseguire il codice normale
-        exec(code, safe_globals, local_vars)
+        exec(compiled, safe_globals, local_vars)
         raw = local_vars.get("result")
         
         if raw is None:
@@ -488,33 +666,11 @@ def execute_code(code: str, df: pd.DataFrame) -> Any:
                         break
         
         if raw is None:
-            lines = code.strip().split('\n')
-            if lines:
-                last_line = lines[-1].strip()
-                preceding_lines = lines[:-1]
-
-                # Se l'ultima riga sembra una "espressione", proviamo ad estrarre il valore
-                if (
-                    last_line and
-                    not last_line.startswith('#') and
-                    not any(last_line.startswith(stmt) for stmt in ['if ', 'for ', 'while ', 'def ', 'class ', 'import ', 'from '])
-                ):
-                    try:
-                        # Esegui tutto il codice precedente
-                        exec('\n'.join(preceding_lines), safe_globals, local_vars)
-
-                        # Valuta l'ultima riga come espressione
-                        raw = eval(last_line, safe_globals, local_vars)
-                    except Exception:
-                        # Se fallisce, prova ad assegnarlo come `result = ...`
-                        try:
-                            modified_code = '\n'.join(preceding_lines + [f'result = {last_line}'])
-                            local_vars_retry = {}
-                            exec(modified_code, safe_globals, local_vars_retry)
-                            raw = local_vars_retry.get("result")
-                        except:
-                            pass
-        
+            # Valore dell'ultima espressione (o dell'ultima assegnazione), già catturato durante l'esecuzione
+            raw = local_vars.get(_LAST_EXPRESSION)
+            if raw is None and last_assigned:
+                raw = local_vars.get(last_assigned)
+
         if raw is None:
             # Debug: mostra tutte le variabili definite
             defined_vars = [k for k in local_vars.keys() if not k.startswith('_')]
@@ -532,24 +688,12 @@ def execute_code(code: str, df: pd.DataFrame) -> Any:
                 }
             }
         
-        # Rimuovi indici e serializza DataFrame/Series
-        if isinstance(raw, pd.DataFrame):
-            result_data = raw.reset_index(drop=True).to_dict(orient="records")
-            return _format_list_of_dicts_as_markdown(result_data)
-
-        if isinstance(raw, pd.Series):
-            result_data = raw.reset_index(drop=True).to_frame(name="valore").to_dict(orient="records")
-            return _format_list_of_dicts_as_markdown(result_data)
-
-        # Se è una lista di dizionari, prova comunque a formattare come Markdown
-        if isinstance(raw, list) and all(isinstance(r, dict) for r in raw):
-            return _format_list_of_dicts_as_markdown(raw)
-
         # Se è una lista/dict vuota, aggiungi info di debug
         if isinstance(raw, (list, dict)) and not raw:
             print(f"Warning: Result is empty {type(raw).__name__}")
 
-        return raw
+        # DataFrame, Series e liste di dizionari diventano tabelle (senza gli indici di riga senza nome)
+        return CodeResult.from_value(raw)
         
     except Exception as e:
         return {"error": str(e), "traceback": traceback.format_exc(), "code": code}
\ No newline at end of file